@@ -3,8 +3,11 @@
 # the full copyright notices and license terms.
 
 from trytond.pool import Pool
+from . import esale
 from . import magento_core
+from . import magento_order
 from . import magento_referential
+from . import party
 from . import product
 from . import sale
 from . import shop
@@ -19,6 +22,7 @@ def register():
         magento_core.MagentoCustomerGroup,
         magento_core.MagentoRegion,
         magento_core.MagentoAppCustomer,
+        magento_core.MagentoAppCustomerShard,
         magento_core.MagentoShopStatus,
         magento_core.MagentoAppCustomerMagentoStoreview,
         magento_core.MagentoAppCountry,
@@ -28,6 +32,14 @@ def register():
         magento_core.MagentoTax,
         magento_core.MagentoAppDefaultTax,
         magento_referential.MagentoExternalReferential,
+        magento_order.MagentoOrderLedger,
+        magento_order.MagentoOrderFailed,
+        magento_order.MagentoOrderStaging,
+        magento_order.MagentoOrderBackfill,
+        magento_order.MagentoOrderBackfillWindow,
+        magento_order.Cron,
+        esale.eSaleAccountTaxRule,
+        party.PartyIdentifier,
         product.Product,
         sale.Sale,
         sale.SaleLine,
@@ -0,0 +1,50 @@
+# This file is part magento module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import PoolMeta
+from trytond.cache import Cache
+from trytond.config import config as config_
+
+__all__ = ['eSaleAccountTaxRule']
+
+TAX_RULE_CACHE_SIZE = config_.getint('magento', 'tax_rule_cache_size',
+    default=1024)
+
+
+class eSaleAccountTaxRule(metaclass=PoolMeta):
+    __name__ = 'esale.account.tax.rule'
+    _compute_cache = Cache('esale.account.tax.rule.compute',
+        size_limit=TAX_RULE_CACHE_SIZE)
+
+    @classmethod
+    def create(cls, vlist):
+        cls._compute_cache.clear()
+        return super(eSaleAccountTaxRule, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._compute_cache.clear()
+        super(eSaleAccountTaxRule, cls).write(*args)
+
+    @classmethod
+    def delete(cls, rules):
+        cls._compute_cache.clear()
+        super(eSaleAccountTaxRule, cls).delete(rules)
+
+    @classmethod
+    def compute(cls, country, subdivision=None, zip=None):
+        '''
+        Compute tax rule. Results are cached by country, subdivision and zip
+        until tax rules change.
+        '''
+        key = (country.id if country else None,
+            subdivision.id if subdivision else None,
+            zip)
+        rule_id = cls._compute_cache.get(key, -1)
+        if rule_id != -1:
+            return cls(rule_id) if rule_id is not None else None
+
+        rule = super(eSaleAccountTaxRule, cls).compute(country, subdivision,
+            zip)
+        cls._compute_cache.set(key, rule.id if rule else None)
+        return rule
@@ -0,0 +1,242 @@
+# This file is part magento module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import magento
+import logging
+import socket
+import threading
+from contextlib import contextmanager
+from xmlrpc.client import Fault, ProtocolError, Transport, SafeTransport
+from magento.api import API
+from trytond.config import config as config_
+
+__all__ = ['magento_client', 'app_credentials', 'clear_clients',
+    'is_timeout', 'MagentoMultiCall']
+
+POOL_SIZE = config_.getint('magento', 'pool_size', default=4)
+MULTICALL_SIZE = config_.getint('magento', 'multicall_size', default=50)
+TIMEOUT = config_.getfloat('magento', 'timeout', default=300)
+# HTTP status of a gateway or server that gave up on a slow request
+TIMEOUT_STATUS = (502, 503, 504)
+# Magento fault: Session expired. Try to relogin.
+SESSION_EXPIRED_FAULTS = (5,)
+
+logger = logging.getLogger(__name__)
+
+
+class TimeoutTransportMixin(object):
+    '''
+    XML-RPC transport with a socket timeout: a hung call raises
+    socket.timeout instead of blocking forever
+    '''
+
+    def make_connection(self, host):
+        connection = super(TimeoutTransportMixin, self).make_connection(host)
+        connection.timeout = TIMEOUT
+        return connection
+
+
+class TimeoutTransport(TimeoutTransportMixin, Transport):
+    pass
+
+
+class SafeTimeoutTransport(TimeoutTransportMixin, SafeTransport):
+    pass
+
+
+def is_timeout(error):
+    '''
+    Check if an error of a Magento call is a timeout
+    :param error: exception
+    return bool
+    '''
+    if isinstance(error, socket.timeout):
+        return True
+    return (isinstance(error, ProtocolError)
+        and error.errcode in TIMEOUT_STATUS)
+
+
+class PooledAPI(object):
+    '''
+    Mixin for Magento API classes kept in the pool.
+    Login again when the Magento session expires.
+    '''
+
+    def login(self):
+        if self.client is None:
+            self.connect()
+        return self.__enter__()
+
+    def call(self, resource_path, arguments):
+        try:
+            return super(PooledAPI, self).call(resource_path, arguments)
+        except Fault as e:
+            if e.faultCode not in SESSION_EXPIRED_FAULTS:
+                raise
+            logger.info('Magento %s. Session expired. Login again' % (
+                self.url))
+            self.login()
+            return super(PooledAPI, self).call(resource_path, arguments)
+
+    def multiCall(self, calls):
+        try:
+            return super(PooledAPI, self).multiCall(calls)
+        except Fault as e:
+            if e.faultCode not in SESSION_EXPIRED_FAULTS:
+                raise
+            logger.info('Magento %s. Session expired. Login again' % (
+                self.url))
+            self.login()
+            return super(PooledAPI, self).multiCall(calls)
+
+
+class MagentoClientPool(object):
+    '''
+    Logged Magento API clients kept by app credentials and API class.
+    The xmlrpc transport of each client keeps its HTTP connection alive, so
+    a borrowed client reuses both the connection and the session.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = {}
+        self.classes = {}
+        self.lock = threading.Lock()
+
+    def pooled_class(self, api_class):
+        # Mocked or custom API factories are used as they are
+        if not (isinstance(api_class, type) and issubclass(api_class, API)):
+            return api_class
+        with self.lock:
+            if api_class not in self.classes:
+                self.classes[api_class] = type(api_class.__name__,
+                    (PooledAPI, api_class), {'__abstract__': True})
+            return self.classes[api_class]
+
+    def get(self, credentials, api_class):
+        key = (credentials, api_class)
+        with self.lock:
+            clients = self.idle.get(key)
+            if clients:
+                return clients.pop()
+        _, uri, username, password = credentials
+        api_class = self.pooled_class(api_class)
+        if isinstance(api_class, type) and issubclass(api_class, API):
+            transport = (SafeTimeoutTransport() if uri.startswith('https')
+                else TimeoutTransport())
+            client = api_class(uri, username, password, transport=transport)
+        else:
+            client = api_class(uri, username, password)
+        return client.__enter__()
+
+    def put(self, credentials, api_class, client):
+        key = (credentials, api_class)
+        with self.lock:
+            clients = self.idle.setdefault(key, [])
+            if len(clients) < self.size:
+                clients.append(client)
+                return
+        self.close(client)
+
+    @staticmethod
+    def close(client):
+        try:
+            client.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def clear(self, credentials=None, app_id=None):
+        with self.lock:
+            keys = [k for k in self.idle
+                if (credentials is None or k[0] == credentials)
+                and (app_id is None or k[0][0] == app_id)]
+            clients = []
+            for key in keys:
+                clients.extend(self.idle.pop(key))
+        for client in clients:
+            self.close(client)
+
+
+_pool = MagentoClientPool(POOL_SIZE)
+
+
+def app_credentials(app):
+    '''
+    Get credentials of a Magento APP to use out of the transaction
+    :param app: magento.app
+    return tuple (id, uri, username, password)
+    '''
+    return (app.id, app.uri, app.username, app.password)
+
+
+def clear_clients(app):
+    '''
+    Close the pooled clients of a Magento APP (all credentials)
+    :param app: magento.app
+    '''
+    _pool.clear(app_id=app.id)
+
+
+@contextmanager
+def magento_client(app, resource='API'):
+    '''
+    Borrow a logged Magento API client from the pool
+    :param app: magento.app or credentials tuple from app_credentials
+    :param resource: str name of magento API class (API, Order, Customer,...)
+    '''
+    credentials = app if isinstance(app, tuple) else app_credentials(app)
+    api_class = getattr(magento, resource)
+    client = _pool.get(credentials, api_class)
+    try:
+        yield client
+    except BaseException:
+        # the connection could be broken: not reuse it
+        _pool.close(client)
+        raise
+    else:
+        _pool.put(credentials, api_class, client)
+
+
+class MagentoMultiCall(object):
+    '''
+    Queue Magento API calls and send them by batches with multiCall.
+    Each result or fault is returned with the key of its call.
+    '''
+
+    def __init__(self, client, size=None):
+        '''
+        :param client: logged Magento API client
+        :param size: int calls for each multiCall request
+        '''
+        self.client = client
+        self.size = size or MULTICALL_SIZE
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def add(self, key, resource_path, arguments):
+        '''
+        Queue a call
+        :param key: value to identify the call in the results
+        :param resource_path: str Magento API method (sales_order.info,...)
+        :param arguments: list
+        '''
+        self.calls.append((key, resource_path, arguments))
+
+    def execute(self):
+        '''
+        Send the queued calls by batches (generator)
+        yield tuples (key, result, fault); fault is a xmlrpc Fault or None
+        '''
+        calls, self.calls = self.calls, []
+        for i in range(0, len(calls), self.size):
+            batch = calls[i:i + self.size]
+            values = self.client.multiCall([[resource_path, arguments]
+                    for _, resource_path, arguments in batch])
+            for (key, _, _), value in zip(batch, values):
+                if isinstance(value, dict) and value.get('isFault'):
+                    yield key, None, Fault(value.get('faultCode'),
+                        value.get('faultMessage'))
+                else:
+                    yield key, value, None
@@ -1,24 +1,49 @@
 # This file is part magento module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-import magento
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
-from trytond.modules.magento.tools import unaccent, remove_newlines
+from trytond.transaction import Transaction
+from trytond.backend import DatabaseOperationalError
+from trytond.config import config as config_
+from trytond.tools import grouped_slice
+from trytond.modules.magento.tools import (unaccent, remove_newlines,
+    address_key, contact_key, diff_values, list_windows, MagentoJobMixin)
+from trytond.modules.magento.magento_client import (magento_client,
+    clear_clients, MagentoMultiCall)
 from trytond.modules.esale.tools import is_a_vat
 import stdnum.eu.vat as vat
+import magento
+import datetime
+import hashlib
+import json
 import logging
 
 __all__ = ['MagentoApp', 'MagentoWebsite', 'MagentoStoreGroup',
     'MagentoStoreView', 'MagentoCustomerGroup', 'MagentoRegion',
-    'MagentoAppCustomer', 'MagentoShopStatus',
+    'MagentoAppCustomer', 'MagentoAppCustomerShard', 'MagentoShopStatus',
     'MagentoAppCustomerMagentoStoreview', 'MagentoAppCountry',
     'MagentoAppLanguage', 'MagentoTax', 'MagentoAppDefaultTax',
     'MagentoApp2', 'MagentoStoreGroup2']
 
+CUSTOMERS_SHARD_SIZE = config_.getint('magento', 'customers_shard_size',
+    default=5000)
+CUSTOMERS_CONCURRENCY = config_.getint('magento', 'customers_concurrency',
+    default=4)
+CUSTOMERS_DELAY = config_.getint('magento', 'customers_delay', default=60)
+CUSTOMERS_TIMEOUT = config_.getint('magento', 'customers_timeout',
+    default=1800)
+CUSTOMERS_PAGE_SIZE = config_.getint('magento', 'customers_page_size',
+    default=500)
+CUSTOMERS_SYNC_DAYS = config_.getint('magento', 'customers_sync_days',
+    default=30)
+# customers without a sync date: all changes since the first Magento release
+CUSTOMERS_SYNC_START = datetime.datetime(2008, 1, 1)
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+STORE_LISTS = ('ol_websites.list', 'ol_groups.list', 'ol_storeviews.list')
 logger = logging.getLogger(__name__)
 
 
@@ -55,10 +80,23 @@ class MagentoApp(ModelSQL, ModelView):
         help='This Integer is the range to import (filter)')
     to_id_customers = fields.Integer('To ID Customers',
         help='This Integer is the range from import (filter)')
+    customer_shards = fields.One2Many('magento.app.customer.shard',
+        'magento_app', 'Customer Shards', readonly=True)
+    store_fingerprint = fields.Char('Store Fingerprint', readonly=True,
+        help='Hash of the Magento websites, store groups and store views of '
+        'the last store sync')
+    customers_updated_at = fields.DateTime('Customers Updated At',
+        help='Customers changed in Magento after this date (UTC) are '
+        'updated by the customer sync')
+    customers_sync_until = fields.DateTime('Customers Sync Until',
+        readonly=True, help='End date of the customer sync in progress')
     identifier_type = fields.Selection([
         (None, 'ID'),
         ('sku', 'Code'),
         ], 'Identifier Type', help='SKU Identifier Type (product code or ID)')
+    orders_chunk_size = fields.Integer('Orders Chunk Size', readonly=True,
+        help='Orders requested to Magento in each call. It is learned from '
+        'the response time and size of the last imports')
 
     @classmethod
     def __setup__(cls):
@@ -69,12 +107,23 @@ class MagentoApp(ModelSQL, ModelView):
                 'core_customer_group': {},
                 'core_regions': {},
                 'core_import_customers': {},
+                'core_sync_customers': {},
                 })
 
     @staticmethod
     def default_identifier_type():
         return 'sku'
 
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        for apps, values in zip(actions, actions):
+            # pooled clients are logged with the old credentials
+            if set(values) & {'uri', 'username', 'password'}:
+                for app in apps:
+                    clear_clients(app)
+        super(MagentoApp, cls).write(*args)
+
     def get_default_lang(self, name):
         for l in self.languages:
             if l.default:
@@ -86,6 +135,7 @@ class MagentoApp(ModelSQL, ModelView):
     def test_connection(self, apps):
         '''Test connection to Magento APP'''
         for app in apps:
+            # new client, not pooled: login again with the credentials
             with magento.API(app.uri, app.username, app.password):
                 raise UserError(gettext('magento.msg_connection_successfully'))
 
@@ -115,11 +165,34 @@ class MagentoApp(ModelSQL, ModelView):
         shop.payment_term = config.sale_payment_term
         return shop
 
+    def set_orders_chunk_size(self, size):
+        '''
+        Save the orders chunk size learned by an import in its own short
+        transaction. Imports of the same APP run at the same time (backfill
+        windows): the size is only a hint, so a lock or serialization error
+        skips the write and the import is not retried
+        :param size: int
+        '''
+        if size == self.orders_chunk_size:
+            return
+        with Transaction().new_transaction() as transaction:
+            try:
+                self.write([self.__class__(self.id)], {
+                        'orders_chunk_size': size,
+                        })
+                transaction.commit()
+            except DatabaseOperationalError as e:
+                transaction.rollback()
+                logger.info('Magento %s. Not saved orders chunk size %s: %s'
+                    % (self.name, size, e))
+
     @classmethod
-    def core_store_website(self, app, magento_api):
+    def core_store_website(self, app, magento_api, mgnwebsites=None):
         '''
-        Create website and sale shop
-        return list website ids
+        Create or update websites; new websites also get a sale shop
+        Only the websites that changed are written
+        :param mgnwebsites: list of Magento websites; get them if None
+        return list of websites created
         '''
         pool = Pool()
         MagentoExternalReferential = pool.get('magento.external.referential')
@@ -130,65 +203,95 @@ class MagentoApp(ModelSQL, ModelView):
         if not sale_configuration.sale_warehouse:
             raise UserError(gettext('magento.msg_sale_configuration'))
 
-        websites = []
-        for mgnwebsite in magento_api.call('ol_websites.list', []):
-            website_ref = MagentoExternalReferential.get_mgn2try(app,
-                'magento.website', mgnwebsite['website_id'])
-
+        if mgnwebsites is None:
+            mgnwebsites = magento_api.call('ol_websites.list', [])
+        website_refs = MagentoExternalReferential.get_mgn2try_multi(app,
+            'magento.website', [w['website_id'] for w in mgnwebsites])
+        websites = dict((w.id, w) for w in MagentoWebsite.browse(
+                [r.try_id for r in website_refs.values()]))
+
+        to_create = []
+        to_write = []
+        for mgnwebsite in mgnwebsites:
+            website_ref = website_refs.get(mgnwebsite['website_id'])
             if not website_ref:
-                name = mgnwebsite['name']
-                code = mgnwebsite['code']
-                values = {
-                    'name': name,
-                    'code': code,
+                to_create.append(mgnwebsite)
+                continue
+            magento_website = websites[website_ref.try_id]
+            values = diff_values(magento_website, {
+                    'name': mgnwebsite['name'],
+                    'code': mgnwebsite['code'],
+                    })
+            if values:
+                to_write.extend(([magento_website], values))
+        if to_write:
+            MagentoWebsite.write(*to_write)
+
+        if not to_create:
+            return []
+
+        websites = MagentoWebsite.create([{
+                    'name': mgnwebsite['name'],
+                    'code': mgnwebsite['code'],
                     'magento_app': app.id,
                     'available': True,
-                    }
-                website = MagentoWebsite.create([values])[0]
-                websites.append(website)
-                MagentoExternalReferential.set_external_referential(app,
-                    'magento.website', website.id, mgnwebsite['website_id'])
-                logger.info(
-                    'Create Website. Magento APP: %s. Magento website ID %s' %
-                    (app.name, mgnwebsite['website_id']))
-
-                # Sale Shop
-                shop = self.get_sale_shop(name)
-                shop.magento_website = website
-                shop, = SaleShop.create([shop._save_values])
-                MagentoExternalReferential.set_external_referential(app,
-                    'sale.shop', shop.id, mgnwebsite['website_id'])
-                logger.info(
-                    'Create Sale Shop. Magento APP: %s. Website %s - %s. '
-                    'Sale Shop ID %s' % (
-                    app.name,
-                    website.id,
-                    mgnwebsite['website_id'],
-                    shop.id,
-                    ))
-            else:
-                magento_website = MagentoWebsite(website_ref.try_id)
-                magento_website.name = mgnwebsite['name']
-                magento_website.code = mgnwebsite['code']
-                magento_website.save()
+                    } for mgnwebsite in to_create])
+        MagentoExternalReferential.set_external_referentials(app,
+            'magento.website', [(website.id, mgnwebsite['website_id'])
+                for website, mgnwebsite in zip(websites, to_create)])
+        for mgnwebsite in to_create:
+            logger.info(
+                'Create Website. Magento APP: %s. Magento website ID %s' %
+                (app.name, mgnwebsite['website_id']))
+
+        # Sale Shop
+        shops = []
+        for website, mgnwebsite in zip(websites, to_create):
+            shop = self.get_sale_shop(mgnwebsite['name'])
+            shop.magento_website = website
+            shops.append(shop._save_values)
+        shops = SaleShop.create(shops)
+        MagentoExternalReferential.set_external_referentials(app,
+            'sale.shop', [(shop.id, mgnwebsite['website_id'])
+                for shop, mgnwebsite in zip(shops, to_create)])
+        for shop, website, mgnwebsite in zip(shops, websites, to_create):
+            logger.info(
+                'Create Sale Shop. Magento APP: %s. Website %s - %s. '
+                'Sale Shop ID %s' % (
+                app.name,
+                website.id,
+                mgnwebsite['website_id'],
+                shop.id,
+                ))
         return websites
 
     @classmethod
-    def core_store_storegroup(self, app, magento_api):
+    def core_store_storegroup(self, app, magento_api, mgnstoregroups=None):
         '''
-        Create store group
-        return list storegroup ids
+        Create or update store groups
+        Only the store groups that changed are written; a store group of a
+        website not synced is skipped
+        :param mgnstoregroups: list of Magento store groups; get them if None
+        return list of store groups created
         '''
         pool = Pool()
         MagentoExternalReferential = pool.get('magento.external.referential')
         StoreGroup = pool.get('magento.storegroup')
 
-        storegroups = []
-        for mgnstoregroup in magento_api.call('ol_groups.list', []):
-            storegroup_ref = MagentoExternalReferential.get_mgn2try(app,
-                'magento.storegroup', mgnstoregroup['group_id'])
-            website_ref = MagentoExternalReferential.get_mgn2try(app,
-                'magento.website', mgnstoregroup['website_id'])
+        if mgnstoregroups is None:
+            mgnstoregroups = magento_api.call('ol_groups.list', [])
+        storegroup_refs = MagentoExternalReferential.get_mgn2try_multi(app,
+            'magento.storegroup', [g['group_id'] for g in mgnstoregroups])
+        website_refs = MagentoExternalReferential.get_mgn2try_multi(app,
+            'magento.website', [g['website_id'] for g in mgnstoregroups])
+        storegroups = dict((g.id, g) for g in StoreGroup.browse(
+                [r.try_id for r in storegroup_refs.values()]))
+
+        to_create = []
+        to_write = []
+        for mgnstoregroup in mgnstoregroups:
+            storegroup_ref = storegroup_refs.get(mgnstoregroup['group_id'])
+            website_ref = website_refs.get(mgnstoregroup['website_id'])
             if not website_ref:
                 logger.error(
                     'Not found website. Not create Store Group. '
@@ -198,54 +301,75 @@ class MagentoApp(ModelSQL, ModelView):
                     mgnstoregroup.get('group_id'),
                     mgnstoregroup.get('website_id'),
                     ))
+            elif not storegroup_ref:
+                to_create.append((mgnstoregroup, {
+                            'name': mgnstoregroup['name'],
+                            'magento_website': website_ref.try_id,
+                            'available': True,
+                            }))
             else:
-                if not storegroup_ref:
-                    values = {
+                store_group = storegroups[storegroup_ref.try_id]
+                values = diff_values(store_group, {
                         'name': mgnstoregroup['name'],
                         'magento_website': website_ref.try_id,
-                        'available': True,
-                    }
-                    storegroup = StoreGroup.create([values])[0]
-                    storegroups.append(storegroup)
-                    MagentoExternalReferential.set_external_referential(app,
-                        'magento.storegroup', storegroup.id,
-                        mgnstoregroup['group_id'])
-                    logger.info(
-                        'Create Store Group. Magento APP: %s. '
-                        'Magento Store Group ID: %s - %s. '
-                        'Magento Website ID: %s' % (
-                        app.name,
-                        storegroup.id,
-                        mgnstoregroup.get('group_id'),
-                        mgnstoregroup.get('website_id'),
-                        ))
-                else:
-                    store_group = StoreGroup(storegroup_ref.try_id)
-                    store_group.name = mgnstoregroup['name']
-                    store_group.magento_website = website_ref.try_id
-                    store_group.save()
+                        })
+                if values:
+                    to_write.extend(([store_group], values))
+        if to_write:
+            StoreGroup.write(*to_write)
+
+        if not to_create:
+            return []
+
+        storegroups = StoreGroup.create([v for _, v in to_create])
+        MagentoExternalReferential.set_external_referentials(app,
+            'magento.storegroup', [(storegroup.id, mgnstoregroup['group_id'])
+                for storegroup, (mgnstoregroup, _) in zip(
+                    storegroups, to_create)])
+        for storegroup, (mgnstoregroup, _) in zip(storegroups, to_create):
+            logger.info(
+                'Create Store Group. Magento APP: %s. '
+                'Magento Store Group ID: %s - %s. '
+                'Magento Website ID: %s' % (
+                app.name,
+                storegroup.id,
+                mgnstoregroup.get('group_id'),
+                mgnstoregroup.get('website_id'),
+                ))
         return storegroups
 
     @classmethod
-    def core_store_storeview(self, app, magento_api):
+    def core_store_storeview(self, app, magento_api, mgnstoreviews=None):
         '''
-        Create store view
-        return list storeview ids
+        Create, update or delete store views
+        Only the store views that changed are written; a store view of a
+        store group not synced is skipped, and store views not in Magento
+        are deleted with their languages
+        :param mgnstoreviews: list of Magento store views; get them if None
+        return list of store views of Magento
         '''
         pool = Pool()
         MagentoExternalReferential = pool.get('magento.external.referential')
         StoreView = pool.get('magento.storeview')
         MagentoAppLanguage = pool.get('magento.app.language')
 
-        store_views_to_remove = StoreView.search([
-                ('magento_storegroup.magento_website.magento_app', '=', app),
-                ])
+        local_storeviews = dict((v.id, v) for v in StoreView.search([
+                    ('magento_storegroup.magento_website.magento_app', '=', app),
+                    ]))
+        store_views_to_remove = set(local_storeviews.keys())
+        if mgnstoreviews is None:
+            mgnstoreviews = magento_api.call('ol_storeviews.list', [])
+        storeview_refs = MagentoExternalReferential.get_mgn2try_multi(app,
+            'magento.storeview', [v['store_id'] for v in mgnstoreviews])
+        storegroup_refs = MagentoExternalReferential.get_mgn2try_multi(app,
+            'magento.storegroup', [v['group_id'] for v in mgnstoreviews])
+
         storeviews = []
-        for mgnstoreview in magento_api.call('ol_storeviews.list', []):
-            storeview_ref = MagentoExternalReferential.get_mgn2try(app,
-                'magento.storeview', mgnstoreview['store_id'])
-            storegroup_ref = MagentoExternalReferential.get_mgn2try(app,
-                'magento.storegroup', mgnstoreview['group_id'])
+        to_create = []
+        to_write = []
+        for mgnstoreview in mgnstoreviews:
+            storeview_ref = storeview_refs.get(mgnstoreview['store_id'])
+            storegroup_ref = storegroup_refs.get(mgnstoreview['group_id'])
             if not storegroup_ref:
                 logger.error(
                     'Not found Store Group. Not create Store View. '
@@ -253,58 +377,125 @@ class MagentoApp(ModelSQL, ModelView):
                     app.name,
                     mgnstoreview.get('group_id'),
                     ))
+            elif not storeview_ref:
+                to_create.append((mgnstoreview, {
+                            'name': mgnstoreview['name'],
+                            'code': mgnstoreview['code'],
+                            'magento_storegroup': storegroup_ref.try_id,
+                            'available': True,
+                            }))
             else:
-                if not storeview_ref:
-                    values = {
-                        'name': mgnstoreview['name'],
+                store_view = local_storeviews.get(storeview_ref.try_id)
+                if not store_view:
+                    store_view = StoreView(storeview_ref.try_id)
+                values = diff_values(store_view, {
                         'code': mgnstoreview['code'],
+                        'name': mgnstoreview['name'],
                         'magento_storegroup': storegroup_ref.try_id,
-                        'available': True,
-                    }
-                    storeview = StoreView.create([values])[0]
-                    storeviews.append(storeview)
-                    MagentoExternalReferential.set_external_referential(app,
-                        'magento.storeview', storeview.id,
-                        mgnstoreview['store_id'])
-                    logger.info(
-                        'Create Store View. Magento APP: %s. '
-                        'Magento Store View ID: %s - %s' % (
-                        app.name,
-                        storeview.id,
-                        mgnstoreview['store_id'],
-                        ))
-                else:
-                    store_view = StoreView(storeview_ref.try_id)
-                    store_view.code = mgnstoreview['code']
-                    store_view.name = mgnstoreview['name']
-                    store_view.magento_storegroup = storegroup_ref.try_id
-                    store_view.save()
-                    storeviews.append(store_view)
-                    store_views_to_remove.remove(store_view)
-        magento_app_languages = MagentoAppLanguage.search([('app', '=', app),
-                ('storeview', 'in', store_views_to_remove)])
-        if magento_app_languages:
-            MagentoAppLanguage.delete(magento_app_languages)
-
-        StoreView.delete(store_views_to_remove)
+                        })
+                if values:
+                    to_write.extend(([store_view], values))
+                storeviews.append(store_view)
+                store_views_to_remove.discard(store_view.id)
+        if to_write:
+            StoreView.write(*to_write)
+
+        if to_create:
+            new_storeviews = StoreView.create([v for _, v in to_create])
+            MagentoExternalReferential.set_external_referentials(app,
+                'magento.storeview', [
+                    (storeview.id, mgnstoreview['store_id'])
+                    for storeview, (mgnstoreview, _) in zip(
+                        new_storeviews, to_create)])
+            for storeview, (mgnstoreview, _) in zip(
+                    new_storeviews, to_create):
+                logger.info(
+                    'Create Store View. Magento APP: %s. '
+                    'Magento Store View ID: %s - %s' % (
+                    app.name,
+                    storeview.id,
+                    mgnstoreview['store_id'],
+                    ))
+            storeviews.extend(new_storeviews)
+
+        store_views_to_remove = [local_storeviews[i]
+            for i in store_views_to_remove]
+        if store_views_to_remove:
+            magento_app_languages = MagentoAppLanguage.search([
+                    ('app', '=', app),
+                    ('storeview', 'in', [v.id for v in store_views_to_remove]),
+                    ])
+            if magento_app_languages:
+                MagentoAppLanguage.delete(magento_app_languages)
+            StoreView.delete(store_views_to_remove)
         return storeviews
 
     @classmethod
     @ModelView.button
     def core_store(self, apps):
         '''
-        Import Store Magento to Tryton
-        Create new values if not exist; not update or delete
-        - Websites
-        - Store Group / Tryton Sale Shop
+        Import Store Magento to Tryton, also when not changed
+        - Websites / Tryton Sale Shop
+        - Store Group
         - Store View
         '''
 
         for app in apps:
-            with magento.API(app.uri, app.username, app.password) as magento_api:
-                self.core_store_website(app, magento_api)
-                self.core_store_storegroup(app, magento_api)
-                self.core_store_storeview(app, magento_api)
+            app.sync_store(force=True)
+
+    @classmethod
+    def core_store_cron(cls):
+        '''
+        Cron import Store Magento; APPs without changes are skipped
+        '''
+        for app in cls.search([]):
+            app.sync_store()
+
+    def sync_store(self, force=False):
+        '''
+        Get websites, store groups and store views in one request and sync
+        them when they changed from the last sync
+        The fingerprint is only saved when all of them are synced: a store
+        skipped is synced again by the next run
+        :param force: bool sync also when not changed
+        '''
+        MagentoExternalReferential = Pool().get(
+            'magento.external.referential')
+
+        with magento_client(self) as magento_api:
+            multicall = MagentoMultiCall(magento_api)
+            for path in STORE_LISTS:
+                multicall.add(path, path, [])
+            lists = {}
+            for path, result, fault in multicall.execute():
+                if fault:
+                    raise fault
+                lists[path] = result
+
+            fingerprint = hashlib.sha256(json.dumps(
+                    [lists[p] for p in STORE_LISTS], sort_keys=True,
+                    default=str).encode('utf-8')).hexdigest()
+            if not force and fingerprint == self.store_fingerprint:
+                logger.info('Magento %s. Store not changed' % (self.name))
+                return
+
+            mgnwebsites, mgnstoregroups, mgnstoreviews = [
+                lists[p] for p in STORE_LISTS]
+            self.core_store_website(self, magento_api, mgnwebsites)
+            self.core_store_storegroup(self, magento_api, mgnstoregroups)
+            self.core_store_storeview(self, magento_api, mgnstoreviews)
+
+        for model, key, records in (
+                ('magento.website', 'website_id', mgnwebsites),
+                ('magento.storegroup', 'group_id', mgnstoregroups),
+                ('magento.storeview', 'store_id', mgnstoreviews)):
+            mgn_ids = set(r[key] for r in records)
+            if len(MagentoExternalReferential.get_mgn2try_multi(self, model,
+                        mgn_ids)) != len(mgn_ids):
+                logger.warning('Magento %s. Store not fully synced: %s' % (
+                    self.name, model))
+                return
+        self.write([self], {'store_fingerprint': fingerprint})
 
     @classmethod
     @ModelView.button
@@ -318,42 +509,49 @@ class MagentoApp(ModelSQL, ModelView):
         MagentoCustomerGroup = pool.get('magento.customer.group')
 
         for app in apps:
-            with magento.CustomerGroup(app.uri, app.username, app.password) \
-                    as customer_group_api:
-                for customer_group in customer_group_api.list():
-                    groups = MagentoCustomerGroup.search([
-                        ('customer_group', '=', customer_group[
-                                'customer_group_id'
-                                ]),
-                        ('magento_app', '=', app.id),
-                        ], limit=1)
-                    if groups:
-                        logger.warning(
-                            'Group %s already exists. Magento APP: %s: '
-                            'Not created' % (
-                            customer_group['customer_group_code'],
-                            app.name,
-                            ))
-                        continue
+            with magento_client(app, 'CustomerGroup') as customer_group_api:
+                customer_groups = customer_group_api.list()
+
+            groups = MagentoCustomerGroup.search([
+                    ('magento_app', '=', app.id),
+                    ])
+            existing = set(g.customer_group for g in groups)
+
+            to_create = []
+            for customer_group in customer_groups:
+                if int(customer_group['customer_group_id']) in existing:
+                    logger.warning(
+                        'Group %s already exists. Magento APP: %s: '
+                        'Not created' % (
+                        customer_group['customer_group_code'],
+                        app.name,
+                        ))
+                    continue
+                existing.add(int(customer_group['customer_group_id']))
+                to_create.append(customer_group)
+
+            if not to_create:
+                continue
 
-                    values = {
+            magento_customer_groups = MagentoCustomerGroup.create([{
                         'name': customer_group['customer_group_code'],
                         'customer_group': customer_group['customer_group_id'],
                         'magento_app': app.id,
-                    }
-                    magento_customer_group = \
-                        MagentoCustomerGroup.create([values])[0]
-                    MagentoExternalReferential.set_external_referential(
-                        app,
-                        'magento.customer.group',
-                        magento_customer_group.id,
+                        } for customer_group in to_create])
+            MagentoExternalReferential.set_external_referentials(app,
+                'magento.customer.group', [
+                    (magento_customer_group.id,
                         customer_group['customer_group_id'])
-                    logger.info(
-                        'Create Group %s. Magento APP %s.ID %s' % (
-                        customer_group['customer_group_code'],
-                        app.name,
-                        magento_customer_group,
-                        ))
+                    for magento_customer_group, customer_group in zip(
+                        magento_customer_groups, to_create)])
+            for magento_customer_group, customer_group in zip(
+                    magento_customer_groups, to_create):
+                logger.info(
+                    'Create Group %s. Magento APP %s.ID %s' % (
+                    customer_group['customer_group_code'],
+                    app.name,
+                    magento_customer_group,
+                    ))
 
     @classmethod
     @ModelView.button
@@ -369,25 +567,35 @@ class MagentoApp(ModelSQL, ModelView):
         for app in apps:
             to_create = []
 
-            with magento.Region(app.uri, app.username, app.password) as region_api:
-                countries = app.magento_countries
-                if not countries:
-                    logger.warning('Select a countries '
-                        'to load regions')
-                    continue
+            countries = app.magento_countries
+            if not countries:
+                logger.warning('Select a countries '
+                    'to load regions')
+                continue
 
+            existing = set(r.region_id for r in MagentoRegion.search([
+                        ('magento_app', '=', app.id),
+                        ]))
+
+            with magento_client(app, 'Region') as region_api:
+                multicall = MagentoMultiCall(region_api)
                 for country in countries:
-                    regions = region_api.list(country.code)
+                    multicall.add(country.code, 'directory_region.list',
+                        [country.code])
+
+                for country_code, regions, fault in multicall.execute():
+                    if fault:
+                        logger.error(
+                            'Magento %s. Error get regions %s: %s' % (
+                            app.name, country_code, fault.faultString))
+                        continue
                     for region in regions:
-                        mag_regions = MagentoRegion.search([
-                            ('region_id', '=', region['region_id']),
-                            ('magento_app', '=', app.id)
-                            ], limit=1)
-                        if mag_regions:
+                        if int(region['region_id']) in existing:
                             logger.warning(
                                 'Magento %s. Region %s already exists' % (
                                 app.name, region['region_id']))
                             continue
+                        existing.add(int(region['region_id']))
 
                         subdivisions = CountrySubdivision.search([
                             ('name', 'ilike', region['code'])
@@ -410,9 +618,153 @@ class MagentoApp(ModelSQL, ModelView):
 
     @classmethod
     @ModelView.button
-    def core_import_customers(self, apps):
+    def core_import_customers(cls, apps):
         """Import Magento Customers to Tryton
         Create new parties, addresses and contacts; not update or delete
+        Large ranges are split in shards imported by the queue workers
+        """
+        Shard = Pool().get('magento.app.customer.shard')
+
+        for app in apps:
+            if not (app.from_id_customers and app.to_id_customers):
+                raise UserError(
+                    gettext('magento.msg_not_import_customers'))
+            from_id, to_id = app.from_id_customers, app.to_id_customers
+
+            if Shard.search([
+                        ('magento_app', '=', app.id),
+                        ('state', '!=', 'done'),
+                        ], count=True):
+                raise UserError(gettext('magento.msg_customer_shards_running',
+                        app=app.rec_name))
+
+            if to_id - from_id + 1 > CUSTOMERS_SHARD_SIZE:
+                # From ID Customers moves forward when all shards are done
+                shards = Shard.create_shards(app, from_id, to_id)
+                Shard.enqueue(shards)
+                logger.info('Magento %s. Import customers %s - %s by %s '
+                    'shards' % (app.name, from_id, to_id, len(shards)))
+                continue
+
+            def progress(last_id, customers):
+                cls.write([app], {'from_id_customers': last_id + 1})
+            if not app.import_customers(from_id, to_id, progress):
+                raise UserError(
+                    gettext('magento.msg_not_import_customers'))
+
+            # Update last import
+            cls.write([app], {
+                    'from_id_customers': to_id + 1,
+                    'to_id_customers': None,
+                    })
+
+    @classmethod
+    @ModelView.button
+    def core_sync_customers(cls, apps):
+        """Update Magento Customers changed from the last sync
+        Parties, addresses and contacts are updated in place
+        """
+        for app in apps:
+            app.sync_customers()
+
+    @classmethod
+    def sync_customers_cron(cls):
+        """Cron update Magento Customers changed"""
+        cls.core_sync_customers(cls.search([
+                    ('customers_updated_at', '!=', None),
+                    ]))
+
+    def sync_customers(self):
+        """Update Magento Customers changed after customers_updated_at
+        Customers are listed by windows of updated_at dates; each window is
+        saved and committed and the date moves forward to its end. A sync
+        run ends at the date it starts
+        """
+        app = self
+        until = app.customers_sync_until
+        if not until:
+            # last second finished: later changes are in the next run
+            until = (datetime.datetime.utcnow()
+                - datetime.timedelta(seconds=1)).replace(microsecond=0)
+            self.write([app], {'customers_sync_until': until})
+            Transaction().commit()
+
+        # Magento dates have seconds: from the next second is "greater than"
+        if app.customers_updated_at:
+            start = app.customers_updated_at + datetime.timedelta(seconds=1)
+        else:
+            start = CUSTOMERS_SYNC_START
+        logger.info('Magento %s. Sync customers: %s - %s' % (
+            app.name, start, until))
+
+        total = 0
+        with magento_client(app, 'Customer') as customer_api:
+            for end, customers in list_windows(customer_api.list, {},
+                    'updated_at', start, until, CUSTOMERS_PAGE_SIZE,
+                    max_seconds=CUSTOMERS_SYNC_DAYS * 86400):
+                if customers:
+                    app.save_customers(customers)
+                    total += len(customers)
+                self.write([app], {'customers_updated_at': end})
+                Transaction().commit()
+
+        self.write([app], {'customers_sync_until': None})
+        Transaction().commit()
+        logger.info('Magento %s. End sync %s customers' % (app.name, total))
+
+    def import_customers(self, from_id, to_id, progress=None):
+        """Import Magento Customers of a range of IDs by pages
+        Each page is saved and committed; progress is called before the
+        commit with the last ID and the customers of the page
+        :param from_id: int first Magento customer ID
+        :param to_id: int last Magento customer ID
+        :param progress: function(last ID, customers) to save the progress
+        return int number of customers listed
+        """
+        total = 0
+        for start in range(from_id, to_id + 1, CUSTOMERS_PAGE_SIZE):
+            end = min(start + CUSTOMERS_PAGE_SIZE - 1, to_id)
+            customers = self.import_customers_page(start, end)
+            if not customers:
+                continue
+            total += customers
+            if progress:
+                progress(end, customers)
+            Transaction().commit()
+        return total
+
+    def import_customers_page(self, from_id, to_id):
+        """Import Magento Customers of a page of IDs
+        :param from_id: int first Magento customer ID
+        :param to_id: int last Magento customer ID
+        return int number of customers listed
+        """
+        app = self
+        logger.info('Start import customers %s' % (app.name))
+
+        with magento_client(app, 'Customer') as customer_api:
+            ofilter = {
+                'entity_id': {
+                    'from': from_id,
+                    'to': to_id,
+                    },
+                }
+            customers = customer_api.list(ofilter)
+        if not customers:
+            return 0
+
+        logger.info('Import Magento %s customers: %s' % (
+            len(customers), ofilter))
+        self.save_customers(customers)
+
+        logger.info('End import customers')
+        return len(customers)
+
+    def save_customers(self, customers):
+        """Save Magento Customers to Tryton
+        Customers linked to a party by magento.app.customer are updated in
+        place; others are matched by email or VAT or a new party is created
+        :param customers: list of dicts (Magento customer.list)
         """
         pool = Pool()
         Party = pool.get('party.party')
@@ -422,193 +774,227 @@ class MagentoApp(ModelSQL, ModelView):
         Region = pool.get('magento.region')
         Country = pool.get('country.country')
         Subdivision = pool.get('country.subdivision')
+        AppCustomer = pool.get('magento.app.customer')
+        CustomerGroup = pool.get('magento.customer.group')
 
+        app = self
         to_save = []
-        for app in apps:
-            logger.info('Start import customers %s' % (app.name))
-
-            with magento.Customer(app.uri, app.username, app.password) as customer_api:
-                data = {}
-                customers = []
-
-                if app.from_id_customers and app.to_id_customers:
-                    ofilter = {
-                        'entity_id': {
-                            'from': app.from_id_customers,
-                            'to': app.to_id_customers,
-                            },
-                        }
-                    customers = customer_api.list(ofilter)
-                    data = {
-                        'from_id_customers': app.to_id_customers + 1,
-                        'to_id_customers': None,
-                        }
-
-                if not customers:
-                    raise UserError(
-                        gettext('magento.msg_not_import_customers'))
-
-                logger.info('Import Magento %s customers: %s' % (
-                    len(customers), ofilter))
-
-                # Update last import
-                self.write([app], data)
-
-                for customer in customers:
-                    customer_id = customer['customer_id']
-                    email = customer['email']
-                    vat_code = customer.get('taxvat')
-
-                    parties = Party.search([
-                        ('esale_email', '=', email),
-                        ], limit=1)
-                    if not parties and vat_code:
-                        vat_code = vat_code.upper()
-                        identifiers = Identifier.search(['OR',
-                            ('code', '=', vat_code),
-                            ('code', 'like', '%' + vat_code),
-                            ], limit=1)
-                        if identifiers:
-                            parties = [identifiers[0].party]
-                    if parties:
-                        party, = parties
+        addresses_to_save = []
+        with magento_client(app, 'CustomerAddress') as address_api:
+            # customer addresses by batches
+            customer_addresses = {}
+            multicall = MagentoMultiCall(address_api)
+            for customer in customers:
+                multicall.add(customer['customer_id'],
+                    'customer_address.list', [customer['customer_id']])
+            for customer_id, addrs, fault in multicall.execute():
+                if fault:
+                    logger.error(
+                        'Magento %s. Error get addresses customer %s: '
+                        '%s' % (app.name, customer_id, fault.faultString))
+                    continue
+                customer_addresses[customer_id] = addrs
+
+            # existing parties by email and VAT in bulk
+            parties_by_email = {}
+            emails = list(set(c['email'] for c in customers if c.get('email')))
+            for sub_emails in grouped_slice(emails):
+                for party in Party.search([
+                            ('esale_email', 'in', list(sub_emails)),
+                            ], order=[('id', 'DESC')]):
+                    parties_by_email[party.esale_email] = party
+            identifiers_by_vat = Identifier.search_by_suffix(
+                [c.get('taxvat') for c in customers
+                    if c.get('taxvat') and c.get('email')
+                    and c['email'] not in parties_by_email])
+
+            # customers linked to a party
+            links = {}
+            customer_ids = [int(c['customer_id']) for c in customers]
+            for sub_ids in grouped_slice(customer_ids):
+                for link in AppCustomer.search([
+                            ('magento_app', '=', app.id),
+                            ('magento_customer_id', 'in', list(sub_ids)),
+                            ]):
+                    links[link.magento_customer_id] = link
+
+            saved = set()
+            parties = {}
+            for customer in customers:
+                customer_id = customer['customer_id']
+                email = customer['email']
+                vat_code = customer.get('taxvat')
+
+                link = links.get(int(customer_id))
+                if link:
+                    party = link.party
+                    if (customer.get('firstname') and customer.get('lastname')):
+                        name = '%s %s' % (customer['firstname'], customer['lastname'])
+                        party.name = unaccent(name).title()
+                    party.esale_email = email
+                else:
+                    party = parties_by_email.get(email)
+                if not party and vat_code:
+                    vat_code = vat_code.upper()
+                    identifier = identifiers_by_vat.get(vat_code)
+                    if identifier:
+                        party = identifier.party
+                if not party:
+                    party = Party()
+                    if (customer.get('firstname') and customer.get('lastname')):
+                        name = '%s %s' % (customer['firstname'], customer['lastname'])
+                        party.name = unaccent(name).title()
                     else:
-                        party = Party()
-                        if (customer.get('firstname') and customer.get('lastname')):
-                            name = '%s %s' % (customer['firstname'], customer['lastname'])
-                            party.name = unaccent(name).title()
-                        else:
-                            party.name = email
-                        party.esale_email = email
-                        party.addresses = None
-                        party.contact_mechanisms = None
-                        party.identifiers = None
-
-                    addresses = []
-                    contacts = []
-                    with magento.CustomerAddress(app.uri, app.username, app.password) as address_api:
-                        for addr in address_api.list(customer_id):
-                            street = remove_newlines(unaccent(addr['street']).title())
-                            zip = addr['postcode']
-
-                            address_exist = False
-                            for address in party.addresses:
-                                if address.zip == zip and address.street == street:
-                                    address_exist = True
-                                    break
-                            for address in addresses:
-                                if address.zip == zip and address.street == street:
-                                    address_exist = True
-                                    break
-                            if not address_exist:
-                                address = Address()
-                                name = '%s %s' % (addr['firstname'], addr['lastname'])
-                                address.name = unaccent(name).title()
-                                if not (customer.get('firstname') and customer.get('lastname')):
-                                    party.name = name
-                                address.zip = addr['postcode']
-                                address.street = remove_newlines(unaccent(addr['street']).title())
-                                address.city = unaccent(addr['city']).title()
-                                if addr['is_default_billing']:
-                                    address.invoice = True
-                                if addr['is_default_shipping']:
-                                    address.delivery = True
-
-                                # get region (subdivision) and country
-                                country = None
-                                countries = Country.search([
-                                    ('code', '=', addr.get('country_id').upper()),
-                                    ], limit=1)
-                                if countries:
-                                    country, = countries
-                                    address.country = country
-                                if addr.get('region_id'):
-                                    regions = Region.search([
-                                        ('region_id', '=', addr.get('region_id')),
-                                        ], limit=1)
-                                    if regions:
-                                        region, = regions
-                                        address.subdivision = region.subdivision
-                                        address.country = region.subdivision.country
-                                if addr.get('region'): # magento 1.5
-                                    subdivisions = Subdivision.search([
-                                        ('name', 'ilike', addr.get('region')),
-                                        ('type', '=', 'province'),
-                                        ('country', '=', country),
-                                        ], limit=1)
-                                    if subdivisions:
-                                        subdivision, = subdivisions
-                                        address.subdivision = subdivision
-                                        address.country = subdivision.country
-                                addresses.append(address)
-
-                            # VAT
-                            if not party.identifiers:
-                                vat_country = addr.get('country_id')
-
-                                if vat_code and is_a_vat(vat_code):
-                                    is_vat = False
-                                    if vat_country and vat_code:
-                                        code = '%s%s' % (vat_country.upper(), vat_code)
-                                        if vat.is_valid(code):
-                                            vat_code = code
-                                            is_vat = True
-
-                                    identifier = Identifier()
-                                    identifier.code = vat_code
-                                    if is_vat:
-                                        identifier.type = 'eu_vat'
-                                    party.identifiers = [identifier]
-
-                            # contact mechanism: email + phone
-                            email_exist = False
-                            for contact in party.contact_mechanisms:
-                                if contact.value == email:
-                                    email_exist = True
-                                    break
-                            for contact in contacts:
-                                if contact.value != email:
-                                    email_exist = True
-                                    break
-                            if not email_exist:
-                                contact_email = Contact()
-                                contact_email.type = 'email'
-                                contact_email.value = email
-                                contacts.append(contact_email)
-
-                            if addr.get('telephone'):
-                                phone = addr['telephone']
-                                phone_exist = False
-                                for contact in party.contact_mechanisms:
-                                    if contact.value == phone:
-                                        phone_exist = True
-                                        break
-                                for contact in contacts:
-                                    if contact.value != phone:
-                                        email_exist = True
-                                        break
-                                if not phone_exist:
-                                    contact_email = Contact()
-                                    contact_email.type = 'phone'
-                                    contact_email.value = phone
-                                    contacts.append(contact_email)
-
-                    if addresses:
-                        if party.addresses:
-                            addresses += party.addresses
-                        party.addresses = addresses
-                    if contacts:
-                        if party.contact_mechanisms:
-                            contacts += party.contact_mechanisms
-                        party.contact_mechanisms = contacts
-
+                        party.name = email
+                    party.esale_email = email
+                    party.addresses = None
+                    party.contact_mechanisms = None
+                    party.identifiers = None
+                    parties_by_email[email] = party
+
+                addresses = []
+                contacts = []
+                address_keys = dict((address_key(a.zip, a.street), a)
+                    for a in party.addresses)
+                contact_keys = set(contact_key(c.value)
+                    for c in party.contact_mechanisms)
+                for addr in customer_addresses.get(customer_id, []):
+                    street = remove_newlines(unaccent(addr['street']).title())
+                    zip = addr['postcode']
+
+                    key = address_key(zip, street)
+                    if key in address_keys and link:
+                        # update the address in place
+                        address = address_keys[key]
+                        if address.id:
+                            name = '%s %s' % (addr['firstname'], addr['lastname'])
+                            address.name = unaccent(name).title()
+                            address.city = unaccent(addr['city']).title()
+                            if addr['is_default_billing']:
+                                address.invoice = True
+                            if addr['is_default_shipping']:
+                                address.delivery = True
+                            addresses_to_save.append(address)
+                    elif key not in address_keys:
+                        address = Address()
+                        address_keys[key] = address
+                        name = '%s %s' % (addr['firstname'], addr['lastname'])
+                        address.name = unaccent(name).title()
+                        if not (customer.get('firstname') and customer.get('lastname')):
+                            party.name = name
+                        address.zip = addr['postcode']
+                        address.street = remove_newlines(unaccent(addr['street']).title())
+                        address.city = unaccent(addr['city']).title()
+                        if addr['is_default_billing']:
+                            address.invoice = True
+                        if addr['is_default_shipping']:
+                            address.delivery = True
+
+                        # get region (subdivision) and country
+                        country = None
+                        countries = Country.search([
+                            ('code', '=', addr.get('country_id').upper()),
+                            ], limit=1)
+                        if countries:
+                            country, = countries
+                            address.country = country
+                        if addr.get('region_id'):
+                            regions = Region.search([
+                                ('region_id', '=', addr.get('region_id')),
+                                ], limit=1)
+                            if regions:
+                                region, = regions
+                                address.subdivision = region.subdivision
+                                address.country = region.subdivision.country
+                        if addr.get('region'): # magento 1.5
+                            subdivisions = Subdivision.search([
+                                ('name', 'ilike', addr.get('region')),
+                                ('type', '=', 'province'),
+                                ('country', '=', country),
+                                ], limit=1)
+                            if subdivisions:
+                                subdivision, = subdivisions
+                                address.subdivision = subdivision
+                                address.country = subdivision.country
+                        addresses.append(address)
+
+                    # VAT
+                    if not party.identifiers:
+                        vat_country = addr.get('country_id')
+
+                        if vat_code and is_a_vat(vat_code):
+                            is_vat = False
+                            if vat_country and vat_code:
+                                code = '%s%s' % (vat_country.upper(), vat_code)
+                                if vat.is_valid(code):
+                                    vat_code = code
+                                    is_vat = True
+
+                            identifier = Identifier()
+                            identifier.code = vat_code
+                            if is_vat:
+                                identifier.type = 'eu_vat'
+                            party.identifiers = [identifier]
+
+                    # contact mechanism: email + phone
+                    if contact_key(email) not in contact_keys:
+                        contact_keys.add(contact_key(email))
+                        contact_email = Contact()
+                        contact_email.type = 'email'
+                        contact_email.value = email
+                        contacts.append(contact_email)
+
+                    if addr.get('telephone'):
+                        phone = addr['telephone']
+                        if contact_key(phone) not in contact_keys:
+                            contact_keys.add(contact_key(phone))
+                            contact_email = Contact()
+                            contact_email.type = 'phone'
+                            contact_email.value = phone
+                            contacts.append(contact_email)
+
+                if addresses:
+                    if party.addresses:
+                        addresses += party.addresses
+                    party.addresses = addresses
+                if contacts:
+                    if party.contact_mechanisms:
+                        contacts += party.contact_mechanisms
+                    party.contact_mechanisms = contacts
+
+                # a party of several customers is saved once
+                if id(party) not in saved:
+                    saved.add(id(party))
                     to_save.append(party)
+                parties[int(customer_id)] = party
 
         if to_save:
             Party.save(to_save)
             logger.info('Saved %s parties' % (len(to_save)))
-
-        logger.info('End import customers')
+        if addresses_to_save:
+            Address.save(addresses_to_save)
+
+        # link customers and parties
+        groups = dict((g.customer_group, g) for g in CustomerGroup.search([
+                    ('magento_app', '=', app.id),
+                    ]))
+        links_to_save = []
+        for customer in customers:
+            customer_id = int(customer['customer_id'])
+            group = groups.get(int(customer.get('group_id') or 0))
+            link = links.get(customer_id)
+            if not link:
+                # also without group: the customer is not matched again
+                link = AppCustomer(magento_app=app,
+                    magento_customer_id=customer_id)
+            link.party = parties[customer_id]
+            link.magento_emailid = customer['email']
+            link.magento_vat = customer.get('taxvat')
+            if group:
+                link.magento_customer_group = group
+            links_to_save.append(link)
+        if links_to_save:
+            AppCustomer.save(links_to_save)
 
 
 class MagentoWebsite(ModelSQL, ModelView):
@@ -683,7 +1069,7 @@ class MagentoAppCustomer(ModelSQL, ModelView):
     party = fields.Many2One('party.party', 'Party', required=True)
     magento_app = fields.Many2One('magento.app', 'Magento App', required=True)
     magento_customer_group = fields.Many2One(  # TODO: Domain
-        'magento.customer.group', 'Customer Group', required=True)
+        'magento.customer.group', 'Customer Group')
     magento_storeview = fields.Many2One('magento.storeview', 'Last Store View',
         readonly=True, help="Last store view where the customer has bought.")
     magento_storeview_ids = fields.Many2Many(
@@ -695,6 +1081,122 @@ class MagentoAppCustomer(ModelSQL, ModelView):
         help='To be able to receive customer VAT number you must set '
         'it in Magento Admin Panel, menu System / Configuration / '
         'Client Configuration / Name and Address Options.')
+    magento_customer_id = fields.Integer('Magento Customer ID', readonly=True,
+        select=True)
+
+
+class MagentoAppCustomerShard(MagentoJobMixin, ModelSQL, ModelView):
+    'Magento App Customer Shard'
+    __name__ = 'magento.app.customer.shard'
+    _job_app = 'magento_app'
+    _job_timeout = CUSTOMERS_TIMEOUT
+    _job_concurrency = CUSTOMERS_CONCURRENCY
+    _job_delay = CUSTOMERS_DELAY
+    magento_app = fields.Many2One('magento.app', 'Magento App', required=True,
+        select=True, ondelete='CASCADE', readonly=True)
+    from_id = fields.Integer('From ID', required=True, readonly=True)
+    to_id = fields.Integer('To ID', required=True, readonly=True)
+    checkpoint = fields.Integer('Checkpoint', readonly=True,
+        help='Last customer ID imported')
+    customers = fields.Integer('Customers', readonly=True)
+    heartbeat = fields.DateTime('Heartbeat', readonly=True,
+        help='Last time the running shard made progress')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], 'State', required=True, readonly=True, select=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(MagentoAppCustomerShard, cls).__setup__()
+        cls._order.insert(0, ('from_id', 'ASC'))
+        cls._buttons.update({
+                'retry': {
+                    'invisible': ~Eval('state').in_(['running', 'failed']),
+                    },
+                })
+
+    @staticmethod
+    def default_customers():
+        return 0
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    def create_shards(cls, app, from_id, to_id):
+        '''
+        Split a range of Magento customer IDs in shards
+        :param app: object
+        :param from_id: int
+        :param to_id: int
+        return list of records
+        '''
+        return cls.create([{
+                    'magento_app': app.id,
+                    'from_id': start,
+                    'to_id': min(start + CUSTOMERS_SHARD_SIZE - 1, to_id),
+                    } for start in range(from_id, to_id + 1,
+                    CUSTOMERS_SHARD_SIZE)])
+
+    def get_rec_name(self, name):
+        return '%s - %s' % (self.from_id, self.to_id)
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, shards):
+        '''
+        Dispatch again the failed shards and the running shards without
+        progress in CUSTOMERS_TIMEOUT (the worker is lost)
+        '''
+        cls.requeue(shards)
+
+    def get_job_app(self):
+        return self.magento_app
+
+    def run_job(self):
+        '''
+        Import the customers of the shard from its checkpoint
+        '''
+        def progress(last_id, customers):
+            self.write([self], {
+                    'checkpoint': last_id,
+                    'customers': (self.customers or 0) + customers,
+                    'heartbeat': datetime.datetime.now(),
+                    })
+
+        self.magento_app.import_customers(
+            (self.checkpoint or self.from_id - 1) + 1, self.to_id, progress)
+
+    @classmethod
+    def jobs_finished(cls, shards):
+        cls.update_apps(list(set(s.magento_app for s in shards)))
+
+    @classmethod
+    def update_apps(cls, apps):
+        '''
+        Move the From ID Customers of the APPs after the range imported
+        when all their shards are done
+        :param apps: list of magento.app
+        '''
+        App = Pool().get('magento.app')
+
+        for app in apps:
+            if not app.to_id_customers:
+                continue
+            if cls.search([
+                        ('magento_app', '=', app.id),
+                        ('state', '!=', 'done'),
+                        ], count=True):
+                continue
+            App.write([app], {
+                    'from_id_customers': app.to_id_customers + 1,
+                    'to_id_customers': None,
+                    })
 
 
 class MagentoShopStatus(ModelSQL, ModelView):
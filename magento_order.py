@@ -0,0 +1,673 @@
+# This file is part magento module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+import hashlib
+import json
+import logging
+import zlib
+from sql import For
+from sql.aggregate import Min
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, Unique, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+from trytond.config import config as config_
+from trytond.pyson import Eval
+from trytond.modules.magento.magento_client import magento_client
+from trytond.modules.magento.tools import MagentoJobMixin
+
+__all__ = ['MagentoOrderLedger', 'MagentoOrderFailed',
+    'MagentoOrderStaging', 'MagentoOrderBackfill',
+    'MagentoOrderBackfillWindow', 'Cron']
+
+RETRY_ATTEMPTS = config_.getint('magento', 'retry_attempts', default=5)
+RETRY_BACKOFF = config_.getint('magento', 'retry_backoff', default=10)
+RETRY_LIMIT = config_.getint('magento', 'retry_limit', default=500)
+STAGING_BATCH = config_.getint('magento', 'staging_batch', default=100)
+STAGING_LIMIT = config_.getint('magento', 'staging_limit', default=1000)
+BACKFILL_CONCURRENCY = config_.getint('magento', 'backfill_concurrency',
+    default=4)
+BACKFILL_DELAY = config_.getint('magento', 'backfill_delay', default=60)
+BACKFILL_TIMEOUT = config_.getint('magento', 'backfill_timeout',
+    default=1800)
+logger = logging.getLogger(__name__)
+
+
+class MagentoOrderLedger(ModelSQL, ModelView):
+    'Magento Order Ledger'
+    __name__ = 'magento.order.ledger'
+    shop = fields.Many2One('sale.shop', 'Shop', required=True, select=True,
+        ondelete='CASCADE')
+    increment_id = fields.Char('Increment ID', required=True)
+    sale = fields.Many2One('sale.sale', 'Sale', ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super(MagentoOrderLedger, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('shop_increment_id_uniq', Unique(t, t.shop, t.increment_id),
+                'magento.msg_order_ledger_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Shop = pool.get('sale.shop')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        sale = Sale.__table__()
+        shop = Shop.__table__()
+
+        created = not backend.TableHandler.table_exist(cls._table)
+
+        super(MagentoOrderLedger, cls).__register__(module_name)
+
+        # Migration: register the Magento sales imported before the ledger
+        if created:
+            cursor.execute(*table.insert(
+                    [table.create_uid, table.create_date, table.shop,
+                        table.increment_id, table.sale],
+                    sale.join(shop, condition=sale.shop == shop.id
+                        ).select(Min(sale.create_uid),
+                        Min(sale.create_date), sale.shop,
+                        sale.number_external, Min(sale.id),
+                        where=(shop.esale_shop_app == 'magento')
+                        & (sale.number_external != None),
+                        group_by=[sale.shop, sale.number_external])))
+
+    @classmethod
+    def get_imported(cls, shop, increment_ids):
+        '''
+        Get the increment IDs already imported in a shop
+        :param shop: object
+        :param increment_ids: list of str
+        return set
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        imported = set()
+        for sub_ids in grouped_slice(increment_ids):
+            cursor.execute(*table.select(table.increment_id,
+                    where=(table.shop == shop.id)
+                    & table.increment_id.in_(list(sub_ids))))
+            imported.update(r for r, in cursor.fetchall())
+        return imported
+
+    @classmethod
+    def register_sales(cls, sales):
+        '''
+        Register sales of Magento shops in the ledger
+        :param sales: list of sale.sale
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        by_shop = {}
+        for sale in sales:
+            if (sale.shop and sale.shop.esale_shop_app == 'magento'
+                    and sale.number_external):
+                by_shop.setdefault(sale.shop, {}).setdefault(
+                    sale.number_external, sale)
+
+        to_create = []
+        for shop, sales in by_shop.items():
+            for sub_ids in grouped_slice(list(sales.keys())):
+                cursor.execute(*table.select(table.increment_id,
+                        where=(table.shop == shop.id)
+                        & table.increment_id.in_(list(sub_ids))))
+                for increment_id, in cursor.fetchall():
+                    del sales[increment_id]
+            to_create.extend({
+                    'shop': shop.id,
+                    'increment_id': increment_id,
+                    'sale': sale.id,
+                    } for increment_id, sale in sales.items())
+        if to_create:
+            cls.create(to_create)
+
+
+class MagentoOrderFailed(ModelSQL, ModelView):
+    'Magento Order Failed'
+    __name__ = 'magento.order.failed'
+    shop = fields.Many2One('sale.shop', 'Shop', required=True, select=True,
+        ondelete='CASCADE', readonly=True)
+    increment_id = fields.Char('Increment ID', required=True, readonly=True)
+    stage = fields.Selection([
+        ('fetch', 'Fetch'),
+        ('create', 'Create'),
+        ], 'Stage', required=True, readonly=True,
+        help='Import step where the order failed')
+    error = fields.Text('Error', readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True,
+        help='Retries of the import')
+    next_retry = fields.DateTime('Next Retry', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('abandoned', 'Abandoned'),
+        ], 'State', required=True, readonly=True, select=True)
+    payload = fields.Text('Payload', readonly=True,
+        help='Magento order (JSON) to retry without get it again')
+
+    @classmethod
+    def __setup__(cls):
+        super(MagentoOrderFailed, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('shop_increment_id_uniq', Unique(t, t.shop, t.increment_id),
+                'magento.msg_order_failed_unique'),
+            ]
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._buttons.update({
+                'retry': {},
+                })
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    def register(cls, shop, stage, failures, payloads=None):
+        '''
+        Register orders that failed to import
+        :param shop: object
+        :param stage: str fetch or create
+        :param failures: list of tuples (increment_id, error)
+        :param payloads: dict {increment_id: order dict}
+        '''
+        if not failures:
+            return
+        failures = dict((str(i), str(e)) for i, e in failures)
+        payloads = dict((str(i), json.dumps(p, default=str))
+            for i, p in (payloads or {}).items())
+
+        to_write = []
+        for sub_ids in grouped_slice(list(failures.keys())):
+            for failed in cls.search([
+                        ('shop', '=', shop.id),
+                        ('increment_id', 'in', list(sub_ids)),
+                        ]):
+                values = {
+                    'stage': stage,
+                    'error': failures.pop(failed.increment_id),
+                    }
+                if failed.increment_id in payloads:
+                    values['payload'] = payloads[failed.increment_id]
+                to_write.extend(([failed], values))
+        if to_write:
+            cls.write(*to_write)
+        if failures:
+            cls.create([{
+                        'shop': shop.id,
+                        'increment_id': increment_id,
+                        'stage': stage,
+                        'error': error,
+                        'payload': payloads.get(increment_id),
+                        } for increment_id, error in failures.items()])
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, failed):
+        '''
+        Import again failed orders by shop
+        Orders with payload are created without get them from Magento
+        '''
+        MagentoOrderLedger = Pool().get('magento.order.ledger')
+        now = datetime.datetime.now()
+
+        # schedule next retry before import: failures are kept by register
+        to_write = []
+        for record in failed:
+            attempts = (record.attempts or 0) + 1
+            to_write.extend(([record], {
+                        'attempts': attempts,
+                        'next_retry': now + datetime.timedelta(
+                            minutes=RETRY_BACKOFF * 2 ** (attempts - 1)),
+                        'state': ('abandoned' if attempts >= RETRY_ATTEMPTS
+                            else 'pending'),
+                        }))
+        if to_write:
+            cls.write(*to_write)
+        Transaction().commit()
+
+        by_shop = {}
+        for record in failed:
+            by_shop.setdefault(record.shop, []).append(record)
+
+        for shop, records in by_shop.items():
+            increment_ids = [r.increment_id for r in records]
+            imported = MagentoOrderLedger.get_imported(shop, increment_ids)
+            order_ids, orders = [], []
+            for record in records:
+                if record.increment_id in imported:
+                    continue
+                if record.payload:
+                    orders.append(json.loads(record.payload))
+                else:
+                    order_ids.append(record.increment_id)
+            if order_ids or orders:
+                logger.info('Magento %s. Retry import %s failed sales.' % (
+                    shop.name, len(order_ids) + len(orders)))
+                shop.import_mgn_orders(order_ids, orders)
+
+            # remove orders imported
+            imported = MagentoOrderLedger.get_imported(shop, increment_ids)
+            cls.delete([r for r in records if r.increment_id in imported])
+            Transaction().commit()
+
+    @classmethod
+    def retry_cron(cls):
+        '''
+        Cron retry failed orders
+        '''
+        failed = cls.search([
+                ('state', '=', 'pending'),
+                ['OR',
+                    ('next_retry', '=', None),
+                    ('next_retry', '<=', datetime.datetime.now()),
+                    ],
+                ], limit=RETRY_LIMIT)
+        if failed:
+            cls.retry(failed)
+
+
+class MagentoOrderStaging(ModelSQL, ModelView):
+    'Magento Order Staging'
+    __name__ = 'magento.order.staging'
+    shop = fields.Many2One('sale.shop', 'Shop', required=True, select=True,
+        ondelete='CASCADE', readonly=True)
+    increment_id = fields.Char('Increment ID', required=True, readonly=True)
+    payload_hash = fields.Char('Payload Hash', required=True, readonly=True)
+    payload = fields.Binary('Payload', readonly=True,
+        help='Magento order (JSON compressed with zlib)')
+    state = fields.Selection([
+        ('staged', 'Staged'),
+        ('converting', 'Converting'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], 'State', required=True, readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(MagentoOrderStaging, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('shop_increment_id_hash_uniq',
+                Unique(t, t.shop, t.increment_id, t.payload_hash),
+                'magento.msg_order_staging_unique'),
+            ]
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._buttons.update({
+                'replay': {
+                    'invisible': Eval('state') == 'done',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'staged'
+
+    @staticmethod
+    def dump_payload(order):
+        '''
+        Get the payload and its hash of a Magento order
+        :param order: dict
+        return tuple (payload bytes, hash str)
+        '''
+        data = json.dumps(order, sort_keys=True, default=str).encode('utf-8')
+        return zlib.compress(data), hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def load_payload(payload):
+        '''
+        Get the Magento order of a payload
+        :param payload: bytes
+        return dict
+        '''
+        return json.loads(zlib.decompress(bytes(payload)).decode('utf-8'))
+
+    @classmethod
+    def stage(cls, shop, orders):
+        '''
+        Store Magento orders to convert later.
+        An order with the same payload is only stored once.
+        :param shop: object
+        :param orders: list of dicts
+        return list of staged records
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        to_stage = {}
+        for order in orders:
+            payload, payload_hash = cls.dump_payload(order)
+            to_stage[(str(order.get('increment_id')), payload_hash)] = payload
+
+        for sub_keys in grouped_slice(list(to_stage.keys())):
+            sub_keys = list(sub_keys)
+            cursor.execute(*table.select(table.increment_id,
+                    table.payload_hash,
+                    where=(table.shop == shop.id)
+                    & table.increment_id.in_([i for i, _ in sub_keys])))
+            for key in cursor.fetchall():
+                to_stage.pop(tuple(key), None)
+
+        if not to_stage:
+            return []
+        return cls.create([{
+                    'shop': shop.id,
+                    'increment_id': increment_id,
+                    'payload_hash': payload_hash,
+                    'payload': payload,
+                    } for (increment_id, payload_hash), payload
+                in to_stage.items()])
+
+    @classmethod
+    def enqueue(cls, staged):
+        '''
+        Dispatch the conversion of staged orders to the queue by batches
+        :param staged: list of records
+        '''
+        with Transaction().set_context(queue_name='magento'):
+            for sub_staged in grouped_slice(staged, STAGING_BATCH):
+                cls.__queue__.convert(list(sub_staged))
+
+    @classmethod
+    @ModelView.button
+    def replay(cls, staged):
+        # converting orders are also replayed: their job could be lost
+        cls.convert(staged, states=['staged', 'converting', 'failed'])
+
+    @classmethod
+    def claim(cls, staged, states):
+        '''
+        Set staged orders as converting; an order is only claimed by one
+        job or cron
+        :param staged: list of records
+        :param states: list of str states to claim
+        return list of claimed records
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        claimed = []
+        for record in staged:
+            cursor.execute(*table.update([table.state], ['converting'],
+                    where=(table.id == record.id)
+                    & table.state.in_(list(states))))
+            if cursor.rowcount:
+                claimed.append(record.id)
+        return cls.browse(claimed)
+
+    @classmethod
+    def convert(cls, staged, states=None):
+        '''
+        Create sales from staged orders, without call Magento
+        :param staged: list of records
+        :param states: list of str states to convert; staged if None
+        '''
+        MagentoOrderLedger = Pool().get('magento.order.ledger')
+
+        staged = cls.claim(staged, states or ['staged'])
+        Transaction().commit()
+
+        by_shop = {}
+        for record in staged:
+            by_shop.setdefault(record.shop, []).append(record)
+
+        for shop, records in by_shop.items():
+            increment_ids = [r.increment_id for r in records]
+            imported = MagentoOrderLedger.get_imported(shop, increment_ids)
+            # last staged payload by order
+            orders = {}
+            for record in sorted(records, key=lambda r: r.id):
+                if record.increment_id not in imported:
+                    orders[record.increment_id] = cls.load_payload(
+                        record.payload)
+            if orders:
+                shop.import_mgn_orders([], list(orders.values()))
+
+            imported = MagentoOrderLedger.get_imported(shop, increment_ids)
+            done = [r for r in records if r.increment_id in imported]
+            failed = [r for r in records if r.increment_id not in imported]
+            if done:
+                cls.write(done, {'state': 'done'})
+            if failed:
+                cls.write(failed, {'state': 'failed'})
+            Transaction().commit()
+
+    @classmethod
+    def convert_cron(cls):
+        '''
+        Cron convert staged orders
+        '''
+        staged = cls.search([
+                ('state', '=', 'staged'),
+                ], order=[('id', 'ASC')], limit=STAGING_LIMIT)
+        if staged:
+            cls.convert(staged)
+
+
+class MagentoOrderBackfill(ModelSQL, ModelView):
+    'Magento Order Backfill'
+    __name__ = 'magento.order.backfill'
+    _states = {
+        'readonly': Eval('state') != 'draft',
+        }
+    _depends = ['state']
+    shop = fields.Many2One('sale.shop', 'Shop', required=True, select=True,
+        ondelete='CASCADE', domain=[
+            ('esale_shop_app', '=', 'magento'),
+            ], states=_states, depends=_depends)
+    date_from = fields.DateTime('Date From', required=True,
+        states=_states, depends=_depends)
+    date_to = fields.DateTime('Date To', required=True,
+        states=_states, depends=_depends)
+    window_hours = fields.Integer('Window Hours', required=True,
+        states=_states, depends=_depends,
+        help='Hours of orders imported by each job')
+    windows = fields.One2Many('magento.order.backfill.window', 'backfill',
+        'Windows', readonly=True)
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ], 'State', required=True, readonly=True)
+    del _states, _depends
+
+    @classmethod
+    def __setup__(cls):
+        super(MagentoOrderBackfill, cls).__setup__()
+        cls._order.insert(0, ('date_from', 'DESC'))
+        cls._buttons.update({
+                'start': {
+                    'invisible': Eval('state') != 'draft',
+                    },
+                'retry': {
+                    'invisible': Eval('state') != 'running',
+                    },
+                })
+
+    @staticmethod
+    def default_window_hours():
+        return 24
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    def get_windows(self):
+        '''
+        Split the date range in windows
+        return list of tuples (from datetime, to datetime)
+        '''
+        step = datetime.timedelta(hours=self.window_hours or 24)
+        windows = []
+        start = self.date_from
+        while start <= self.date_to:
+            end = min(start + step - datetime.timedelta(seconds=1),
+                self.date_to)
+            windows.append((start, end))
+            start = end + datetime.timedelta(seconds=1)
+        return windows
+
+    @classmethod
+    @ModelView.button
+    def start(cls, backfills):
+        '''
+        Create the windows and dispatch them to the queue
+        '''
+        Window = Pool().get('magento.order.backfill.window')
+
+        to_create = []
+        for backfill in backfills:
+            if backfill.state != 'draft':
+                continue
+            to_create.extend({
+                    'backfill': backfill.id,
+                    'date_from': start,
+                    'date_to': end,
+                    } for start, end in backfill.get_windows())
+        cls.write([b for b in backfills if b.state == 'draft'],
+            {'state': 'running'})
+        Window.enqueue(Window.create(to_create))
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, backfills):
+        '''
+        Dispatch again the failed windows and the running windows without
+        progress in BACKFILL_TIMEOUT (the worker is lost)
+        '''
+        Window = Pool().get('magento.order.backfill.window')
+
+        Window.requeue(Window.search([
+                    ('backfill', 'in', [b.id for b in backfills]),
+                    ('state', 'in', ['running', 'failed']),
+                    ]))
+
+    @classmethod
+    def update_state(cls, backfills):
+        '''
+        Set as done the backfills with all windows done
+        '''
+        Window = Pool().get('magento.order.backfill.window')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        # windows are finished by several workers: wait each other on the
+        # backfill rows
+        if transaction.database.has_select_for():
+            for sub_ids in grouped_slice([b.id for b in backfills]):
+                cursor.execute(*table.select(table.id,
+                        where=table.id.in_(list(sub_ids)),
+                        for_=For('UPDATE')))
+        pending = set(w.backfill.id for w in Window.search([
+                    ('backfill', 'in', [b.id for b in backfills]),
+                    ('state', '!=', 'done'),
+                    ]))
+        done = [b for b in backfills
+            if b.state == 'running' and b.id not in pending]
+        if done:
+            cls.write(done, {'state': 'done'})
+
+
+class MagentoOrderBackfillWindow(MagentoJobMixin, ModelSQL, ModelView):
+    'Magento Order Backfill Window'
+    __name__ = 'magento.order.backfill.window'
+    _job_app = 'backfill.shop.magento_website.magento_app'
+    _job_timeout = BACKFILL_TIMEOUT
+    _job_concurrency = BACKFILL_CONCURRENCY
+    _job_delay = BACKFILL_DELAY
+    backfill = fields.Many2One('magento.order.backfill', 'Backfill',
+        required=True, select=True, ondelete='CASCADE', readonly=True)
+    date_from = fields.DateTime('Date From', required=True, readonly=True)
+    date_to = fields.DateTime('Date To', required=True, readonly=True)
+    checkpoint = fields.DateTime('Checkpoint', readonly=True,
+        help='Orders created until this date are imported')
+    orders = fields.Integer('Orders', readonly=True)
+    heartbeat = fields.DateTime('Heartbeat', readonly=True,
+        help='Last time the running window made progress')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], 'State', required=True, readonly=True, select=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(MagentoOrderBackfillWindow, cls).__setup__()
+        cls._order.insert(0, ('date_from', 'ASC'))
+
+    @staticmethod
+    def default_orders():
+        return 0
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    def get_rec_name(self, name):
+        return '%s - %s' % (self.date_from, self.date_to)
+
+    def get_job_app(self):
+        return self.backfill.shop.magento_website.magento_app
+
+    def run_job(self):
+        self.import_orders()
+
+    @classmethod
+    def jobs_finished(cls, windows):
+        Backfill = Pool().get('magento.order.backfill')
+        Backfill.update_state(list(set(w.backfill for w in windows)))
+
+    def import_orders(self):
+        '''
+        Import the orders of the window from its checkpoint
+        '''
+        shop = self.backfill.shop
+        mgnapp = shop.magento_website.magento_app
+        ofilter = shop.get_magento_orders_filter()
+
+        with magento_client(mgnapp, 'Order') as order_api:
+            for window_end, order_ids in shop.list_mgn_order_windows(
+                    order_api, ofilter, self.checkpoint or self.date_from,
+                    self.date_to):
+                orders = shop.import_mgn_order_ids(order_ids)
+                self.write([self], {
+                        'checkpoint': window_end,
+                        'orders': (self.orders or 0) + orders,
+                        'heartbeat': datetime.datetime.now(),
+                        })
+                Transaction().commit()
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            ('magento.order.failed|retry_cron', 'Retry Magento Failed Orders'))
+        cls.method.selection.append(
+            ('magento.order.staging|convert_cron',
+                'Convert Magento Staged Orders'))
+        cls.method.selection.append(
+            ('sale.shop|import_magento_scheduler',
+                'Import Magento Orders (Parallel)'))
+        cls.method.selection.append(
+            ('magento.app|sync_customers_cron', 'Sync Magento Customers'))
+        cls.method.selection.append(
+            ('magento.app|core_store_cron', 'Sync Magento Stores'))
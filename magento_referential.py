@@ -1,8 +1,14 @@
 # This file is part magento module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.model import ModelView, ModelSQL, fields
+from collections import OrderedDict
+from sql.aggregate import Min
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, Unique, fields
 from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.tools import grouped_slice
 
 __all__ = ['MagentoExternalReferential']
 
@@ -16,6 +22,101 @@ class MagentoExternalReferential(ModelSQL, ModelView):
         select=True)
     try_id = fields.Integer('Tryton ID', required=True)
     mgn_id = fields.Integer('Magento ID', required=True)
+    _mapping_cache = Cache('magento.external.referential.mapping',
+        context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(MagentoExternalReferential, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('magento_model_mgn_id_uniq',
+                Unique(t, t.magento_app, t.model, t.mgn_id),
+                'magento.msg_external_referential_mgn_id_unique'),
+            ('magento_model_try_id_uniq',
+                Unique(t, t.magento_app, t.model, t.try_id),
+                'magento.msg_external_referential_try_id_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        table2 = cls.__table__()
+
+        # Migration: remove duplicated mappings before add unique constraints
+        # (once, when they are not added; only PostgreSQL adds them)
+        if (backend.name == 'postgresql'
+                and backend.TableHandler.table_exist(cls._table)):
+            cursor.execute('SELECT 1 FROM pg_constraint WHERE conname = %s',
+                ('%s_magento_model_mgn_id_uniq' % cls._table,))
+            if not cursor.fetchone():
+                for column in ('mgn_id', 'try_id'):
+                    cursor.execute(*table.delete(
+                            where=~table.id.in_(table2.select(Min(table2.id),
+                                    group_by=[table2.magento_app,
+                                        table2.model,
+                                        getattr(table2, column)]))))
+
+        super(MagentoExternalReferential, cls).__register__(module_name)
+
+    @classmethod
+    def create(cls, vlist):
+        cls._mapping_cache.clear()
+        return super(MagentoExternalReferential, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._mapping_cache.clear()
+        super(MagentoExternalReferential, cls).write(*args)
+
+    @classmethod
+    def delete(cls, referentials):
+        cls._mapping_cache.clear()
+        super(MagentoExternalReferential, cls).delete(referentials)
+
+    @classmethod
+    def get_mapping(cls, app, model):
+        '''
+        Get magento app and model mapping in both directions
+        The mapping is loaded in one query and cached until referentials
+        are created, modified or deleted
+        :param app: object
+        :param model: str name model
+        :return tuple of dicts: ({mgn_id: (id, try_id)}, {try_id: (id, mgn_id)})
+        '''
+        key = (app.id, model)
+        mapping = cls._mapping_cache.get(key)
+        if mapping is not None:
+            return mapping
+
+        IrModel = Pool().get('ir.model')
+        table = cls.__table__()
+        ir_model = IrModel.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.join(ir_model,
+                condition=table.model == ir_model.id
+                ).select(table.id, table.try_id, table.mgn_id,
+                where=(table.magento_app == app.id)
+                & (ir_model.model == model)))
+        mgn2try, try2mgn = {}, {}
+        for id_, try_id, mgn_id in cursor.fetchall():
+            mgn2try.setdefault(mgn_id, (id_, try_id))
+            try2mgn.setdefault(try_id, (id_, mgn_id))
+        mapping = (mgn2try, try2mgn)
+        cls._mapping_cache.set(key, mapping)
+        return mapping
+
+    @classmethod
+    def get_model_id(cls, model):
+        '''
+        Get ir.model ID
+        :param model: str name model
+        :return int
+        '''
+        models = Pool().get('ir.model').search([('model', '=', model)],
+            limit=1)
+        return models[0].id
 
     @classmethod
     def set_external_referential(cls, app, model, try_id, mgn_id):
@@ -27,16 +128,96 @@ class MagentoExternalReferential(ModelSQL, ModelView):
         :param mgn_id: int Magento ID
         :return magento_external_referential browseable record
         '''
-        models = Pool().get('ir.model').search([('model', '=', model)],
-            limit=1)
-        values = {
-            'magento_app': app.id,
-            'model': models[0],
-            'try_id': try_id,
-            'mgn_id': mgn_id,
-        }
-        magento_external_referential = cls.create([values])[0]
-        return magento_external_referential
+        return cls.set_external_referentials(app, model,
+            [(try_id, mgn_id)])[0]
+
+    @classmethod
+    def set_external_referentials(cls, app, model, ids):
+        '''
+        Create or update external referentials (upsert)
+        A Magento ID or a Tryton ID already mapped is updated instead of
+        duplicated. Concurrent syncs are not locked: the unique constraints
+        keep one mapping and the sync that loses fails.
+        :param app: object
+        :param model: str name model
+        :param ids: list of tuples (Tryton ID, Magento ID)
+        :return list magento_external_referential browseable records; None
+            for a pair replaced by a later pair of ids
+        '''
+        if not ids:
+            return []
+
+        model_id = cls.get_model_id(model)
+        ids = list(OrderedDict.fromkeys(
+            (int(try_id), int(mgn_id)) for try_id, mgn_id in ids))
+
+        # mappings by Magento ID and by Tryton ID, updated after each change
+        by_mgn, by_try = {}, {}
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            for referential in cls.search([
+                        ('magento_app', '=', app.id),
+                        ('model', '=', model_id),
+                        ['OR',
+                            ('mgn_id', 'in', [m for _, m in sub_ids]),
+                            ('try_id', 'in', [t for t, _ in sub_ids]),
+                            ],
+                        ]):
+                entry = {
+                    'id': referential.id,
+                    'try_id': referential.try_id,
+                    'mgn_id': referential.mgn_id,
+                    }
+                by_mgn[entry['mgn_id']] = entry
+                by_try[entry['try_id']] = entry
+
+        def remove(entry):
+            del by_mgn[entry['mgn_id']]
+            del by_try[entry['try_id']]
+
+        def add(entry):
+            by_mgn[entry['mgn_id']] = entry
+            by_try[entry['try_id']] = entry
+
+        entries = []
+        for try_id, mgn_id in ids:
+            entry = by_mgn.get(mgn_id)
+            other = by_try.get(try_id)
+            if entry and entry is other:
+                entries.append(entry)
+                continue
+            if entry and other:
+                # Tryton ID mapped to another Magento ID: remove it
+                remove(other)
+                other['deleted'] = True
+                if other.get('id'):
+                    cls.delete([cls(other['id'])])
+            entry = entry or other
+            if entry:
+                remove(entry)
+                entry.update(try_id=try_id, mgn_id=mgn_id)
+                if entry.get('id'):
+                    cls.write([cls(entry['id'])], {
+                            'try_id': try_id,
+                            'mgn_id': mgn_id,
+                            })
+            else:
+                entry = {'try_id': try_id, 'mgn_id': mgn_id}
+            add(entry)
+            entries.append(entry)
+
+        to_create = OrderedDict((id(e), e) for e in entries
+            if not e.get('id') and not e.get('deleted'))
+        if to_create:
+            for entry, referential in zip(to_create.values(),
+                    cls.create([{
+                                'magento_app': app.id,
+                                'model': model_id,
+                                'try_id': e['try_id'],
+                                'mgn_id': e['mgn_id'],
+                                } for e in to_create.values()])):
+                entry['id'] = referential.id
+        return [None if e.get('deleted') else cls(e['id']) for e in entries]
 
     @classmethod
     def get_mgn2try(cls, app, model, mgn_id):
@@ -47,17 +228,29 @@ class MagentoExternalReferential(ModelSQL, ModelView):
         :param mgn_id: int Magento ID
         :return id or None
         '''
-        models = Pool().get('ir.model').search([('model', '=', model)],
-            limit=1)
-        values = cls.search([
-            ('magento_app', '=', app.id),
-            ('model', '=', models[0]),
-            ('mgn_id', '=', mgn_id),
-            ], limit=1)
-        if values:
-            return values[0]
-        else:
-            return None
+        return cls.get_mgn2try_multi(app, model, [mgn_id]).get(mgn_id)
+
+    @classmethod
+    def get_mgn2try_multi(cls, app, model, mgn_ids):
+        '''
+        Search magento app, model and magento IDs
+        :param app: object
+        :param model: str name model
+        :param mgn_ids: list of Magento IDs
+        :return dict {Magento ID: referential}; missing IDs are not returned
+        '''
+        mgn2try, _ = cls.get_mapping(app, model)
+        referentials = {}
+        for mgn_id in mgn_ids:
+            try:
+                value = mgn2try.get(int(mgn_id))
+            except (TypeError, ValueError):
+                continue
+            if value:
+                id_, try_id = value
+                referentials[mgn_id] = cls(id_, try_id=try_id,
+                    mgn_id=int(mgn_id))
+        return referentials
 
     @classmethod
     def get_try2mgn(cls, app, model, try_id):
@@ -68,14 +261,26 @@ class MagentoExternalReferential(ModelSQL, ModelView):
         :param try_id: int Tryton ID
         :return id or None
         '''
-        models = Pool().get('ir.model').search([('model', '=', model)],
-            limit=1)
-        values = cls.search([
-            ('magento_app', '=', app.id),
-            ('model', '=', models[0]),
-            ('try_id', '=', try_id),
-            ], limit=1)
-        if values:
-            return values[0]
-        else:
-            return None
+        return cls.get_try2mgn_multi(app, model, [try_id]).get(try_id)
+
+    @classmethod
+    def get_try2mgn_multi(cls, app, model, try_ids):
+        '''
+        Search magento app, model and tryton IDs
+        :param app: object
+        :param model: str name model
+        :param try_ids: list of Tryton IDs
+        :return dict {Tryton ID: referential}; missing IDs are not returned
+        '''
+        _, try2mgn = cls.get_mapping(app, model)
+        referentials = {}
+        for try_id in try_ids:
+            try:
+                value = try2mgn.get(int(try_id))
+            except (TypeError, ValueError):
+                continue
+            if value:
+                id_, mgn_id = value
+                referentials[try_id] = cls(id_, try_id=int(try_id),
+                    mgn_id=mgn_id)
+        return referentials
@@ -0,0 +1,114 @@
+# This file is part magento module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from sql.functions import Function, Upper
+from trytond import backend
+from trytond.model import fields
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['PartyIdentifier']
+
+
+class Reverse(Function):
+    __slots__ = ()
+    _function = 'REVERSE'
+
+
+class PartyIdentifier(metaclass=PoolMeta):
+    __name__ = 'party.identifier'
+    code_reversed = fields.Char('Code Reversed', readonly=True,
+        help='Code reversed to search identifiers that end with a code')
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        exist = backend.TableHandler.table_exist(cls._table)
+        if exist:
+            table_h = backend.TableHandler(cls, module_name)
+            created = not table_h.column_exist('code_reversed')
+
+        super(PartyIdentifier, cls).__register__(module_name)
+
+        # Migration: fill reversed codes
+        if exist and created:
+            if backend.name == 'postgresql':
+                # one statement for all the rows
+                cursor.execute(*table.update([table.code_reversed],
+                        [Reverse(Upper(table.code))]))
+            else:
+                # no REVERSE function (SQLite)
+                cursor.execute(*table.select(table.id, table.code))
+                for id_, code in cursor.fetchall():
+                    cursor.execute(*table.update([table.code_reversed],
+                            [cls.reverse_code(code)], where=table.id == id_))
+
+        # code_reversed is searched with LIKE 'code%': a btree index is
+        # only used with the C collation, so PostgreSQL uses pattern ops
+        table_h = backend.TableHandler(cls, module_name)
+        if backend.name == 'postgresql':
+            table_h.index_action('code_reversed', action='remove')
+            cursor.execute('CREATE INDEX IF NOT EXISTS "%s" ON "%s" '
+                '("code_reversed" varchar_pattern_ops)' % (
+                    '%s_code_reversed_pattern_index' % cls._table,
+                    cls._table))
+        else:
+            table_h.index_action('code_reversed', action='add')
+
+    @staticmethod
+    def reverse_code(code):
+        '''
+        Get the code normalized (uppercase) and reversed
+        :param code: str
+        return str
+        '''
+        if not code:
+            return None
+        return code.upper()[::-1]
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            if 'code' in values:
+                values['code_reversed'] = cls.reverse_code(values['code'])
+        return super(PartyIdentifier, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for identifiers, values in zip(actions, actions):
+            if 'code' in values:
+                values = values.copy()
+                values['code_reversed'] = cls.reverse_code(values['code'])
+            args.extend((identifiers, values))
+        super(PartyIdentifier, cls).write(*args)
+
+    @classmethod
+    def search_by_suffix(cls, codes):
+        '''
+        Search identifiers that are or end with the codes
+        The reversed code column is searched by prefix, so the index is used
+        :param codes: list of str
+        return dict {code: identifier}; codes not found are not returned
+        '''
+        codes = set(c.upper() for c in codes if c)
+        if not codes:
+            return {}
+        identifiers = cls.search(['OR'] + [
+                ('code_reversed', 'like', cls.reverse_code(c) + '%')
+                for c in codes], order=[('id', 'ASC')])
+        found = {}
+        for identifier in identifiers:
+            code = (identifier.code or '').upper()
+            if code in codes:
+                found[code] = identifier
+        for identifier in identifiers:
+            code = (identifier.code or '').upper()
+            for c in codes:
+                if c not in found and code.endswith(c):
+                    found[c] = identifier
+        return found
@@ -5,7 +5,8 @@ from trytond.pool import Pool, PoolMeta
 from decimal import Decimal
 from trytond.modules.magento.tools import base_price_without_tax
 from trytond.config import config as config_
-import magento
+from trytond.modules.magento.magento_client import (magento_client,
+    MagentoMultiCall)
 import logging
 
 __all__ = ['Product']
@@ -74,11 +75,10 @@ class Product(metaclass=PoolMeta):
         MagentoExternalReferential = pool.get('magento.external.referential')
 
         shops = []
-        websites = []
-        for website in product_info.get('websites'):
-            website_ref = MagentoExternalReferential.get_mgn2try(app,
-            'magento.website', website)
-            websites.append(website_ref.try_id)
+        website_refs = MagentoExternalReferential.get_mgn2try_multi(app,
+            'magento.website', product_info.get('websites'))
+        websites = [website_ref.try_id
+            for website_ref in website_refs.values()]
         if websites:
             magento_websites = MagentoWebsite.browse(websites)
             for website in magento_websites:
@@ -138,6 +138,17 @@ class Product(metaclass=PoolMeta):
         :param code: str
         return obj
         '''
+        return self.create_products_magento(shop, [code]).get(code)
+
+    @classmethod
+    def create_products_magento(self, shop, codes):
+        '''
+        Get Magento products info by batches and create
+        Codes not found in Magento are not returned; other errors are raised
+        :param shop: obj
+        :param codes: list of str
+        return dict {code: obj}
+        '''
         Template = Pool().get('product.template')
         MagentoExternalReferential = Pool().get('magento.external.referential')
 
@@ -154,16 +165,30 @@ class Product(metaclass=PoolMeta):
         #~ if mgnapp.product_options:
             #~ codes = code.split('-')
 
-        with magento.Product(mgnapp.uri, mgnapp.username, mgnapp.password) \
-                as product_api:
+        products_info = []
+        with magento_client(mgnapp, 'Product') as product_api:
+            multicall = MagentoMultiCall(product_api)
+            for code in codes:
+                multicall.add(code, 'catalog_product.info',
+                    [code, store_view, None, mgnapp.identifier_type])
             try:
-                product_info = product_api.info(code, store_view,
-                        identifierType=mgnapp.identifier_type)
-            except:
+                for code, product_info, fault in multicall.execute():
+                    if fault:
+                        logger.error(
+                            'Magento %s. Not found product %s: %s' % (
+                            shop.name, code, fault))
+                        continue
+                    products_info.append((code, product_info))
+            except Exception as e:
+                # not a missing product (timeout, server error): the caller
+                # can try again
                 logger.error(
-                    'Magento %s. Not found product %s' % (shop.name, code))
-                return
+                    'Magento %s. Error get products %s: %s' % (
+                    shop.name, ', '.join(codes), e))
+                raise
 
+        products = {}
+        for code, product_info in products_info:
             vals = self.magento_import_product(product_info, shop)
 
             # Shops - websites
@@ -182,4 +207,5 @@ class Product(metaclass=PoolMeta):
             if cost_price:
                 vals['cost_price'] = cost_price
 
-            return Template.create_esale_product(shop, vals)
+            products[code] = Template.create_esale_product(shop, vals)
+        return products
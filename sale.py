@@ -1,7 +1,7 @@
 # This file is part magento module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.model import fields
 from trytond.modules.product import price_digits
 from trytond.config import config as config_
@@ -13,6 +13,13 @@ DISCOUNT_DIGITS = config_.getint('product', 'discount_decimal', default=4)
 class Sale(metaclass=PoolMeta):
     __name__ = 'sale.sale'
 
+    @classmethod
+    def create(cls, vlist):
+        MagentoOrderLedger = Pool().get('magento.order.ledger')
+        sales = super(Sale, cls).create(vlist)
+        MagentoOrderLedger.register_sales(sales)
+        return sales
+
     def convert_magento_status(self):
         '''Return Magento state'''
         states = dict((s.state, {
@@ -2,9 +2,15 @@
 # This file is part magento module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-import magento
 import logging
 import datetime
+import socket
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import (ThreadPoolExecutor, FIRST_COMPLETED,
+    wait)
+from itertools import chain
+from xmlrpc.client import Fault, ProtocolError
 from decimal import Decimal
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
@@ -13,24 +19,275 @@ from trytond.tools import grouped_slice
 from trytond.config import config as config_
 from trytond.pyson import Eval, Not, Equal
 from trytond.modules.magento.tools import (unaccent, party_name,
-    remove_newlines, base_price_without_tax)
+    remove_newlines, base_price_without_tax, prefetch, savepoint,
+    list_windows, AdaptiveChunkSize, DATETIME_FORMAT)
+from trytond.modules.magento.magento_client import (magento_client,
+    app_credentials, is_timeout, MagentoMultiCall)
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.modules.account_invoice_discount.invoice import discount_digits
 
-__all__ = ['SaleShop']
+__all__ = ['SaleShop', 'MagentoOrderResolver']
 
 DIGITS = config_.getint('product', 'price_decimal', default=4)
 PRECISION = Decimal(str(10.0 ** - DIGITS))
 MAX_CONNECTIONS = config_.getint('magento', 'max_connections', default=50)
+PREFETCH_CHUNKS = config_.getint('magento', 'prefetch_chunks', default=2)
+COMMIT_INTERVAL = config_.getint('magento', 'commit_interval', default=50)
+MAX_CHUNK_SIZE = config_.getint('magento', 'max_chunk_size', default=500)
+CHUNK_TARGET_TIME = config_.getfloat('magento', 'chunk_target_time',
+    default=20)
+CHUNK_TARGET_LINES = config_.getint('magento', 'chunk_target_lines',
+    default=2000)
+FETCH_RETRIES = config_.getint('magento', 'fetch_retries', default=2)
+FETCH_BACKOFF = config_.getfloat('magento', 'fetch_backoff', default=1)
+LIST_PAGE_SIZE = config_.getint('magento', 'list_page_size', default=0)
+WINDOW_MAX_ORDERS = config_.getint('magento', 'window_max_orders',
+    default=5000)
+WINDOW_MIN_SECONDS = config_.getint('magento', 'window_min_seconds',
+    default=60)
+SCHEDULER_WORKERS = config_.getint('magento', 'scheduler_workers',
+    default=4)
+APP_CONCURRENCY = config_.getint('magento', 'app_concurrency', default=2)
 PRODUCT_TYPE_OUT_ORDER_LINE = ['configurable']
 logger = logging.getLogger(__name__)
 
 
+class MagentoOrderResolver(object):
+    '''
+    Resolve Magento order values to Tryton records in bulk.
+    One resolver is used for each import run; values are loaded by chunk of
+    orders and conversion methods only read from the resolved maps.
+    '''
+
+    def __init__(self, shop):
+        self.shop = shop
+        self.app = shop.magento_website.magento_app
+        self.products = {}
+        # codes not found in Magento: not requested again in the run
+        self.missing = set()
+        self.regions = None
+        self.subdivisions = None
+        self.loaded_countries = set()
+        self.countries = None
+
+    def order_skus(self, orders):
+        '''
+        Get SKUs from order items
+        :param orders: list of dicts
+        return set
+        '''
+        skus = set()
+        for order in orders:
+            for item in order.get('items') or []:
+                if item.get('product_type') in PRODUCT_TYPE_OUT_ORDER_LINE:
+                    continue
+                sku = item.get('sku')
+                if not sku:
+                    continue
+                skus.add(self.item_code(sku))
+        return skus
+
+    def item_code(self, sku):
+        '''
+        Get the product code of an order item SKU
+        With product options, the product is the last part of the SKU
+        :param sku: str
+        return str
+        '''
+        if self.app.product_options:
+            return sku.split('-')[-1]
+        return sku
+
+    def load_orders(self, orders):
+        '''
+        Preload the records used by a chunk of orders
+        :param orders: list of dicts
+        '''
+        # products not found could be created by the previous chunk
+        for code in [c for c, p in self.products.items()
+                if p is None and c not in self.missing]:
+            del self.products[code]
+        codes = self.order_skus(orders)
+        self.load_products(codes)
+        self.create_products([c for c in codes
+                if self.products[c] is None and c not in self.missing])
+
+    def create_products(self, codes):
+        '''
+        Create the products not found from Magento in one batch
+        Codes Magento does not find are kept as missing for the run; on
+        other errors they are tried again by the next chunk
+        :param codes: list of str
+        '''
+        Product = Pool().get('product.product')
+
+        if not codes:
+            return
+        try:
+            with savepoint('magento_products'):
+                created = Product.create_products_magento(self.shop, codes)
+        except Exception as e:
+            logger.error('Magento %s. Error create products %s: %s' % (
+                self.shop.name, ', '.join(codes), e))
+            return
+        self.missing.update(c for c in codes if c not in created)
+        for code in codes:
+            del self.products[code]
+        self.load_products(codes)
+
+    def load_products(self, codes):
+        '''
+        Resolve product codes in bulk: product code and then product.code
+        :param codes: list of str
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        ProductCode = pool.get('product.code')
+
+        codes = [c for c in set(codes) if c not in self.products]
+        if not codes:
+            return
+
+        for sub_codes in grouped_slice(codes):
+            for product in Product.search([
+                        ('code', 'in', list(sub_codes)),
+                        ]):
+                self.products.setdefault(product.code, product)
+
+        missing = [c for c in codes if c not in self.products]
+        for sub_codes in grouped_slice(missing):
+            for product_code in ProductCode.search([
+                        ('number', 'in', list(sub_codes)),
+                        ]):
+                self.products.setdefault(product_code.number,
+                    product_code.product)
+
+        for code in missing:
+            self.products.setdefault(code, None)
+
+    def load_countries(self):
+        '''
+        Load countries by code and by name
+        '''
+        Country = Pool().get('country.country')
+
+        self.countries = {}
+        for country in Country.search([]):
+            if country.code:
+                self.countries.setdefault(('code', country.code.upper()),
+                    country)
+            self.countries.setdefault(('name', country.name), country)
+
+    def load_regions(self):
+        '''
+        Load Magento regions of the app and subdivisions of the app countries
+        '''
+        pool = Pool()
+        MagentoRegion = pool.get('magento.region')
+        Subdivision = pool.get('country.subdivision')
+
+        self.regions = {}
+        for region in MagentoRegion.search([
+                    ('magento_app', '=', self.app.id),
+                    ]):
+            self.regions.setdefault(region.region_id, region.subdivision)
+
+        self.subdivisions = {}
+        countries = [c.id for c in self.app.magento_countries]
+        if countries:
+            for subdivision in Subdivision.search([
+                        ('country', 'in', countries),
+                        ]):
+                key = (subdivision.country.code,
+                    self.normalize(subdivision.name))
+                self.subdivisions.setdefault(key, subdivision)
+        self.loaded_countries = set(c.code for c in self.app.magento_countries)
+
+    @staticmethod
+    def normalize(name):
+        '''
+        Normalize a name to compare
+        :param name: str
+        return str
+        '''
+        return ' '.join(unaccent(name).split())
+
+    def get_country(self, country):
+        '''
+        Get country from Magento country (code or name)
+        :param country: str
+        return country or None
+        '''
+        if not country:
+            return
+        if self.countries is None:
+            self.load_countries()
+        return (self.countries.get(('code', country.upper()))
+            or self.countries.get(('name', country)))
+
+    def get_subdivision(self, region, country=None):
+        '''
+        Get subdivision (mgn2tryton)
+        :param region: magento ID or string
+        :param country: country code (uppercase)
+        return subdivision or None
+        '''
+        Subdivision = Pool().get('country.subdivision')
+
+        if not region:
+            return
+        if self.regions is None:
+            self.load_regions()
+
+        try:
+            region_id = int(region)
+        except (TypeError, ValueError):
+            region_id = None
+
+        if region_id:
+            if region_id in self.regions:
+                return self.regions[region_id]
+
+        if country:
+            key = (country, self.normalize(region))
+            if key not in self.subdivisions:
+                if country in self.loaded_countries:
+                    return
+                # country not related in the app: search and keep result
+                subdivisions = Subdivision.search([
+                            ('name', 'ilike', region),
+                            ('country.code', '=', country),
+                            ], limit=1)
+                self.subdivisions[key] = (subdivisions[0]
+                    if subdivisions else None)
+            return self.subdivisions[key]
+        return
+
+    def get_product(self, code):
+        '''
+        Get product from code
+        :param code: str
+        return product or None
+        '''
+        if code not in self.products:
+            self.load_products([code])
+        return self.products[code]
+
+
 class SaleShop(metaclass=PoolMeta):
     __name__ = 'sale.shop'
     magento_website = fields.Many2One('magento.website', 'Magento Website',
         readonly=True)
+    magento_checkpoint_from = fields.DateTime('Checkpoint From', readonly=True,
+        help='Start of the window of the order import in progress')
+    magento_checkpoint_to = fields.DateTime('Checkpoint To', readonly=True,
+        help='End of the window of the order import in progress')
+    magento_checkpoint_order = fields.Char('Checkpoint Order', readonly=True,
+        help='Last order committed by the order import in progress')
+    magento_stage_orders = fields.Boolean('Stage Orders',
+        help='Store the Magento orders when they are imported and create '
+        'the sales later by the queue')
 
     @classmethod
     def view_attributes(cls):
@@ -173,15 +430,16 @@ class SaleShop(metaclass=PoolMeta):
 
         return vals
 
-    def mgn2lines_values(self, values, party_values, sales_values):
+    def mgn2lines_values(self, values, party_values, sales_values,
+            resolver=None):
         '''
         Convert magento values to sale lines
         :param values: dict
+        :param resolver: MagentoOrderResolver; a new one if None
         return list(dict)
         '''
         pool = Pool()
         Product = pool.get('product.product')
-        ProductCode = pool.get('product.code')
         SaleLine = pool.get('sale.line')
 
         def is_discount_in_line(self, item, discount_type):
@@ -198,29 +456,21 @@ class SaleShop(metaclass=PoolMeta):
                 return False
 
         app = self.magento_website.magento_app
+        if resolver is None:
+            resolver = MagentoOrderResolver(self)
         vals = []
         sequence = 1
         for item in values.get('items'):
             discount_amount_aux = Decimal('0')
             if item['product_type'] not in PRODUCT_TYPE_OUT_ORDER_LINE:
                 code = item.get('sku')
+                if code:
+                    code = resolver.item_code(code)
                 qty = Decimal(item.get('qty_ordered'))
                 gross_unit_price = Decimal(item.get('base_price'))
                 discount_percent = Decimal(0)
 
-                products = Product.search([
-                    ('code', '=', code),
-                    ], limit=1)
-                if products:
-                    product, = products
-                else:
-                    product_codes = ProductCode.search([
-                        ('number', '=', code)
-                        ], limit=1)
-                    if product_codes:
-                        product = product_codes[0].product
-                    else:
-                        product = None
+                product = resolver.get_product(code)
 
                 if is_discount_in_line(self, item, 'base_discount_amount'):
                     discount_amount = Decimal(item['base_discount_amount'])
@@ -246,7 +496,7 @@ class SaleShop(metaclass=PoolMeta):
                 if app.product_options and item.get('sku'):
                     line = Product.magento_product_type_simple(
                         app, item, gross_unit_price, product, sequence)
-                    line['product'] = item['sku'].split('-')[-1]
+                    line['product'] = code
                 else:
                     # Get Product Type Attribute to transform data
                     method_type = 'magento_product_type_%s' % item.get(
@@ -283,16 +533,18 @@ class SaleShop(metaclass=PoolMeta):
         '''
         return []
 
-    def mgn2party_values(self, values):
+    def mgn2party_values(self, values, resolver=None):
         '''
         Convert magento values to party
         :param values: dict
+        :param resolver: MagentoOrderResolver; a new one if None
         return dict
         '''
         pool = Pool()
-        Country = pool.get('country.country')
         eSaleAccountTaxRule = pool.get('esale.account.tax.rule')
 
+        if resolver is None:
+            resolver = MagentoOrderResolver(self)
         firstname = values.get('customer_firstname')
         lastname = values.get('customer_lastname')
 
@@ -326,13 +578,9 @@ class SaleShop(metaclass=PoolMeta):
         # Add customer/supplier tax rule
         country_id = billing.get('country_id')
         if country_id:
-            countries = Country.search(['OR',
-                ('name', 'like', country_id),
-                ('code', '=', country_id.upper()),
-                ], limit=1)
-            if countries:
-                country, = countries
-                subdivision = self.get_magento_region(
+            country = resolver.get_country(country_id)
+            if country:
+                subdivision = resolver.get_subdivision(
                     billing.get('region_id'),
                     billing.get('country_id'))
                 zip = billing.get('postcode')
@@ -345,12 +593,15 @@ class SaleShop(metaclass=PoolMeta):
 
         return vals
 
-    def mgn2invoice_values(self, values):
+    def mgn2invoice_values(self, values, resolver=None):
         '''
         Convert magento values to invoice address
         :param values: dict
+        :param resolver: MagentoOrderResolver; a new one if None
         return dict
         '''
+        if resolver is None:
+            resolver = MagentoOrderResolver(self)
         billing = values.get('billing_address')
 
         name = party_name(values.get('customer_firstname'),
@@ -367,7 +618,7 @@ class SaleShop(metaclass=PoolMeta):
             'street': remove_newlines(unaccent(billing.get('street')).title()),
             'zip': unaccent(billing.get('postcode')),
             'city': unaccent(billing.get('city')).title(),
-            'subdivision': self.get_magento_region(
+            'subdivision': resolver.get_subdivision(
                 billing.get('region_id'),
                 billing.get('country_id')),
             'country': billing.get('country_id'),
@@ -378,12 +629,15 @@ class SaleShop(metaclass=PoolMeta):
             }
         return vals
 
-    def mgn2shipment_values(self, values):
+    def mgn2shipment_values(self, values, resolver=None):
         '''
         Convert magento values to shipment address
         :param values: dict
+        :param resolver: MagentoOrderResolver; a new one if None
         return dict
         '''
+        if resolver is None:
+            resolver = MagentoOrderResolver(self)
         shipment = values.get('shipping_address')
         if not shipment:
             shipment = values.get('billing_address')
@@ -403,7 +657,7 @@ class SaleShop(metaclass=PoolMeta):
                 remove_newlines(unaccent(shipment.get('street')).title()),
             'zip': shipment.get('postcode'),
             'city': unaccent(shipment.get('city')).title(),
-            'subdivision': self.get_magento_region(
+            'subdivision': resolver.get_subdivision(
                 shipment.get('region_id'),
                 shipment.get('country_id')),
             'country': shipment.get('country_id'),
@@ -414,19 +668,132 @@ class SaleShop(metaclass=PoolMeta):
             }
         return vals
 
-    def import_orders_magento(self, ofilter=None):
+    def get_magento_orders_filter(self):
         '''
-        Import Orders from Magento APP
-        :param ofilter: dict
+        Get Magento orders filter of the shop (store views and states)
+        return dict
         '''
         pool = Pool()
-        Sale = pool.get('sale.sale')
-        User = pool.get('res.user')
         MagentoExternalReferential = pool.get('magento.external.referential')
 
+        mgnapp = self.magento_website.magento_app
+        ofilter = {}
+
+        # filter orders by store views. Get all views from a website
+        # related a shop
+        store_views = []
+        for sgroups in self.magento_website.magento_storegroups:
+            for sview in sgroups.magento_storeviews:
+                if not sview.available:
+                    continue
+                mgn_storeview = MagentoExternalReferential.get_try2mgn(
+                    mgnapp, 'magento.storeview', sview.id)
+                if mgn_storeview:
+                    store_views.append(mgn_storeview.mgn_id)
+        if store_views:
+            ofilter['store_id'] = {'in': store_views}
+        if self.esale_import_states:
+            ofilter['state'] = {'in': self.esale_import_states.split(',')}
+        return ofilter
+
+    def backfill_magento_orders(self, date_from, date_to, window_hours=None):
+        '''
+        Import the historical orders of a date range by windows run in
+        parallel by the queue workers
+        :param date_from: datetime
+        :param date_to: datetime
+        :param window_hours: int hours of each window
+        return magento.order.backfill record
+        '''
+        Backfill = Pool().get('magento.order.backfill')
+
+        backfill = Backfill(shop=self, date_from=date_from, date_to=date_to)
+        if window_hours:
+            backfill.window_hours = window_hours
+        backfill.save()
+        Backfill.start([backfill])
+        return backfill
+
+    @classmethod
+    def import_magento_scheduler(cls, shops=None):
+        '''
+        Import orders and export states of Magento shops in parallel
+        Each shop is run in its own thread and transaction. Shops of the same
+        Magento APP are limited to APP_CONCURRENCY at the same time; they
+        wait in a queue of the APP, not in a thread, and the APPs are
+        served by turns.
+        :param shops: list; all Magento shops available if None
+        '''
+        transaction = Transaction()
+        if shops is None:
+            shops = cls.search([
+                    ('esale_available', '=', True),
+                    ('esale_shop_app', '=', 'magento'),
+                    ('magento_website', '!=', None),
+                    ])
+        if not shops:
+            return
+
+        database_name = transaction.database.name
+        user = transaction.user
+        context = dict(transaction.context)
+        # a queue of shops by APP: only shops of an APP below its limit are
+        # submitted, so a busy APP does not hold the threads of the others
+        queues = OrderedDict()
+        for shop in shops:
+            app_id = shop.magento_website.magento_app.id
+            queues.setdefault(app_id, deque()).append((shop.id, shop.name))
+        running = dict.fromkeys(queues, 0)
+
+        def run(shop_id, name):
+            start = time.time()
+            try:
+                with Transaction().start(database_name, user,
+                        context=context):
+                    shop = cls(shop_id)
+                    shop.import_orders_magento()
+                    shop.export_state_magento()
+            except Exception as e:
+                logger.error('Magento %s. Error scheduler: %s' % (name, e))
+                return name, time.time() - start, e
+            return name, time.time() - start, None
+
+        workers = min(SCHEDULER_WORKERS, len(shops))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            while queues or futures:
+                # round-robin: one shop of each APP with a free slot
+                submitted = True
+                while submitted and len(futures) < workers:
+                    submitted = False
+                    for app_id in list(queues):
+                        if len(futures) >= workers:
+                            break
+                        if running[app_id] >= APP_CONCURRENCY:
+                            continue
+                        shop_id, name = queues[app_id].popleft()
+                        if not queues[app_id]:
+                            del queues[app_id]
+                        running[app_id] += 1
+                        futures[executor.submit(run, shop_id, name)] = app_id
+                        submitted = True
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running[futures.pop(future)] -= 1
+                    name, elapsed, error = future.result()
+                    logger.info('Magento %s. Scheduler %s in %.2fs.' % (
+                        name, 'failed' if error else 'done', elapsed))
+
+    def import_orders_magento(self, ofilter=None):
+        '''
+        Import Orders from Magento APP
+        :param ofilter: dict
+        '''
         mgnapp = self.magento_website.magento_app
         now = datetime.datetime.now()
 
+        windowed = not ofilter
+        resume = windowed and self.magento_checkpoint_to
         if not ofilter:
             start_date = self.esale_from_orders or now
             end_date = self.esale_to_orders or now
@@ -437,32 +804,80 @@ class SaleShop(metaclass=PoolMeta):
                 end_date = end_date - datetime.timedelta(
                         minutes=self.esale_import_delayed)
 
+            if resume:
+                # an import was not finished: continue its window
+                start_date = self.magento_checkpoint_from or start_date
+                end_date = self.magento_checkpoint_to
+                logger.info('Magento %s. Resume import from %s (order %s).' % (
+                    self.name, start_date, self.magento_checkpoint_order))
+
             from_time = self.datetime_to_str(start_date)
             to_time = self.datetime_to_str(end_date)
 
             created_filter = {}
             created_filter['from'] = from_time
             created_filter['to'] = to_time
-            ofilter = {'created_at': created_filter}
-
-            # filter orders by store views. Get all views from a website
-            # related a shop
-            store_views = []
-            for sgroups in self.magento_website.magento_storegroups:
-                for sview in sgroups.magento_storeviews:
-                    if not sview.available:
-                        continue
-                    mgn_storeview = MagentoExternalReferential.get_try2mgn(
-                        mgnapp, 'magento.storeview', sview.id)
-                    if mgn_storeview:
-                        store_views.append(mgn_storeview.mgn_id)
-            if store_views:
-                ofilter['store_id'] = {'in': store_views}
-            if self.esale_import_states:
-                ofilter['state'] = {'in': self.esale_import_states.split(',')}
-
-        with magento.Order(mgnapp.uri, mgnapp.username, mgnapp.password) as \
-                order_api:
+            ofilter = self.get_magento_orders_filter()
+            ofilter['created_at'] = created_filter
+
+        if LIST_PAGE_SIZE:
+            # stream the listing by pages of entity IDs; the date of the
+            # last import is updated when all pages are imported
+            logger.info('Magento %s. Import orders %s by pages of %s.' % (
+                mgnapp.name, ofilter, LIST_PAGE_SIZE))
+            total = 0
+            with magento_client(mgnapp, 'Order') as order_api:
+                for order_ids in self.list_mgn_order_ids(order_api, ofilter,
+                        LIST_PAGE_SIZE):
+                    total += self.import_mgn_order_ids(order_ids)
+            self.write([self], {
+                    'esale_from_orders': now,
+                    'esale_to_orders': None,
+                    })
+            Transaction().commit()
+            if not total:
+                logger.info('Magento %s. Not sales to import.' % (self.name))
+            return
+
+        if windowed:
+            # list by created windows; a window too large is split. The
+            # checkpoint saves the window and the last order committed, so
+            # an import not finished is resumed by the next one
+            delayed = datetime.timedelta(minutes=self.esale_import_delayed or 0)
+            last_id = self.magento_checkpoint_order if resume else None
+            if resume:
+                # orders of the window end when the import was started
+                now = end_date + delayed
+            self.set_magento_checkpoint(last_id, (start_date, end_date))
+            Transaction().commit()
+
+            total = 0
+            with magento_client(mgnapp, 'Order') as order_api:
+                for window_end, order_ids in self.list_mgn_order_windows(
+                        order_api, ofilter, start_date, end_date):
+                    if last_id in order_ids:
+                        order_ids = order_ids[order_ids.index(last_id) + 1:]
+                    last_id = None
+                    total += self.import_mgn_order_ids(order_ids,
+                        checkpoint=True)
+                    self.write([self], {
+                            'esale_from_orders': window_end + delayed,
+                            })
+                    self.set_magento_checkpoint(None, (window_end, end_date))
+                    Transaction().commit()
+            self.write([self], {
+                    'esale_from_orders': now,
+                    'esale_to_orders': None,
+                    'magento_checkpoint_from': None,
+                    'magento_checkpoint_to': None,
+                    'magento_checkpoint_order': None,
+                    })
+            Transaction().commit()
+            if not total:
+                logger.info('Magento %s. Not sales to import.' % (self.name))
+            return
+
+        with magento_client(mgnapp, 'Order') as order_api:
             try:
                 order_ids = [o['increment_id'] for o in order_api.list(ofilter)]
                 logger.info(
@@ -479,28 +894,163 @@ class SaleShop(metaclass=PoolMeta):
         self.write([self], {'esale_from_orders': now, 'esale_to_orders': None})
         Transaction().commit()
 
+        if not self.import_mgn_order_ids(order_ids):
+            logger.info('Magento %s. Not sales to import.' % (self.name))
+
+    def import_mgn_order_ids(self, order_ids, checkpoint=False):
+        '''
+        Import Magento orders not imported yet
+        :param order_ids: list increment IDs
+        :param checkpoint: bool save the last order processed on each commit
+        return int number of orders to import
+        '''
+        MagentoOrderLedger = Pool().get('magento.order.ledger')
+
         if order_ids:
-            sales = Sale.search([
-                ('number_external', 'in', order_ids),
-                ('shop', '=', self.id),
-                ])
-            if sales:
-                # not import sales was imported
-                sales_imported_ids = [s.number_external for s in sales]
-                order_ids = list(set(order_ids)-set(sales_imported_ids))
-                if sales_imported_ids:
-                    logger.warning(
-                        'Magento %s. Skip sales was imported %s'
-                        % (self.name, ', '.join(sales_imported_ids)))
+            # not import sales was imported
+            sales_imported_ids = MagentoOrderLedger.get_imported(self,
+                order_ids)
+            if sales_imported_ids:
+                order_ids = [o for o in order_ids
+                    if o not in sales_imported_ids]
+                logger.warning(
+                    'Magento %s. Skip %s sales was imported'
+                    % (self.name, len(sales_imported_ids)))
 
         if not order_ids:
-            logger.info('Magento %s. Not sales to import.' % (self.name))
-            return
+            return 0
 
         logger.info(
             'Magento %s. Start import %s sales.' % (self.name, len(order_ids)))
+        if self.magento_stage_orders:
+            self.stage_mgn_orders(order_ids, checkpoint=checkpoint)
+        else:
+            self.import_mgn_orders(order_ids, checkpoint=checkpoint)
+        return len(order_ids)
+
+    def set_magento_checkpoint(self, increment_id=None, window=None):
+        '''
+        Save the import checkpoint. It is committed with the orders
+        :param increment_id: str last order processed
+        :param window: tuple (from datetime, to datetime) of the window
+        '''
+        values = {'magento_checkpoint_order': increment_id}
+        if window:
+            values['magento_checkpoint_from'], \
+                values['magento_checkpoint_to'] = window
+        self.write([self], values)
+
+    def list_mgn_order_windows(self, order_api, ofilter, start, end,
+            max_orders=None):
+        '''
+        List Magento orders by created windows (generator)
+        A window is split in two halves when the listing fails or returns
+        more than max_orders orders
+        :param order_api: logged Magento Order API client
+        :param ofilter: dict
+        :param start: datetime
+        :param end: datetime
+        :param max_orders: int; WINDOW_MAX_ORDERS if None
+        yield tuples (window end datetime, list increment IDs)
+        '''
+        mgnapp = self.magento_website.magento_app
+
+        try:
+            for window_end, orders in list_windows(order_api.list, ofilter,
+                    'created_at', start, end, max_orders or WINDOW_MAX_ORDERS,
+                    WINDOW_MIN_SECONDS, self.datetime_to_str):
+                logger.info('Magento %s. Import orders %s until %s.' % (
+                    mgnapp.name, ofilter, window_end))
+                yield window_end, [o['increment_id'] for o in orders]
+        except (socket.timeout, ProtocolError, Fault):
+            logger.error(
+                'Magento %s. Error connection or get earlier date: '
+                '%s.' % (mgnapp.name, ofilter))
+            raise UserError(gettext(
+                    'magento.msg_magento_error_get_orders',
+                    magento=mgnapp.name,
+                    ofilter=ofilter))
+
+    def list_mgn_order_ids(self, order_api, ofilter, page_size):
+        '''
+        List Magento orders by pages (generator)
+        The created date range of the filter is listed by windows of at most
+        page_size orders, so only a page of order headers is kept in memory
+        :param order_api: logged Magento Order API client
+        :param ofilter: dict with created_at from and to
+        :param page_size: int orders of each page
+        yield lists of increment IDs
+        '''
+        created_at = ofilter.get('created_at') or {}
+        if created_at.get('from') and created_at.get('to'):
+            start = datetime.datetime.strptime(created_at['from'],
+                DATETIME_FORMAT)
+            end = datetime.datetime.strptime(created_at['to'],
+                DATETIME_FORMAT)
+            pages = (ids for _, ids in self.list_mgn_order_windows(order_api,
+                        ofilter, start, end, page_size))
+        else:
+            pages = [[o['increment_id'] for o in order_api.list(ofilter)]]
+        for order_ids in pages:
+            # a window not possible to split could have more orders
+            for i in range(0, len(order_ids), page_size):
+                yield order_ids[i:i + page_size]
+
+    def stage_mgn_orders(self, order_ids, checkpoint=False):
+        '''
+        Fetch Magento orders to the staging table and dispatch their
+        conversion to sales to the queue
+        :param order_ids: list increment IDs
+        :param checkpoint: bool save the last order staged on each commit
+        '''
+        pool = Pool()
+        MagentoOrderFailed = pool.get('magento.order.failed')
+        MagentoOrderStaging = pool.get('magento.order.staging')
 
         mgnapp = self.magento_website.magento_app
+        timing = {'fetch': 0.0, 'write': 0.0}
+        chunk_size = AdaptiveChunkSize(
+            mgnapp.orders_chunk_size or MAX_CONNECTIONS,
+            maximum=MAX_CHUNK_SIZE,
+            target_time=CHUNK_TARGET_TIME,
+            target_payload=CHUNK_TARGET_LINES)
+        chunks = prefetch(self.fetch_mgn_orders(app_credentials(mgnapp),
+                order_ids, timing, chunk_size), PREFETCH_CHUNKS)
+
+        total = 0
+        for orders, fetch_failed in chunks:
+            start = time.time()
+            if fetch_failed:
+                MagentoOrderFailed.register(self, 'fetch', fetch_failed)
+            staged = MagentoOrderStaging.stage(self, orders)
+            MagentoOrderStaging.enqueue(staged)
+            if checkpoint and orders:
+                self.set_magento_checkpoint(orders[-1].get('increment_id'))
+            Transaction().commit()
+            total += len(staged)
+            timing['write'] += time.time() - start
+
+        mgnapp.set_orders_chunk_size(chunk_size.size)
+
+        logger.info(
+            'Magento %s. Staged %s sales. Fetch time %.2fs. '
+            'Write time %.2fs' % (self.name, total, timing['fetch'],
+                timing['write']))
+
+    def import_mgn_orders(self, order_ids, orders=None, checkpoint=False):
+        '''
+        Fetch and create Magento orders
+        Orders that fail are kept in magento.order.failed
+        :param order_ids: list increment IDs to get from Magento
+        :param orders: list of dicts; orders already got from Magento
+        :param checkpoint: bool save the last order processed on each commit
+        '''
+        pool = Pool()
+        User = pool.get('res.user')
+        MagentoOrderFailed = pool.get('magento.order.failed')
+
+        mgnapp = self.magento_website.magento_app
+        orders = orders or []
 
         context = Transaction().context
         if not context.get('shop'): # reload context when run cron user
@@ -512,27 +1062,192 @@ class SaleShop(metaclass=PoolMeta):
         context['explode_kit'] = self.esale_explode_kit or False # explode sale lines
         context['esale'] = True
 
+        # fetch next orders in a background thread while current orders
+        # are created
+        timing = {'fetch': 0.0, 'write': 0.0}
+        credentials = app_credentials(mgnapp)
+        chunk_size = AdaptiveChunkSize(
+            mgnapp.orders_chunk_size or MAX_CONNECTIONS,
+            maximum=MAX_CHUNK_SIZE,
+            target_time=CHUNK_TARGET_TIME,
+            target_payload=CHUNK_TARGET_LINES)
+        chunks = iter([])
+        if order_ids:
+            chunks = prefetch(self.fetch_mgn_orders(credentials, order_ids,
+                    timing, chunk_size), PREFETCH_CHUNKS)
+        if orders:
+            chunks = chain(((orders[i:i + MAX_CONNECTIONS], [])
+                    for i in range(0, len(orders), MAX_CONNECTIONS)), chunks)
+
+        failed = []
+        last_id = None
+        resolver = MagentoOrderResolver(self)
         with Transaction().set_context(context):
-            for grouped_order_ids in grouped_slice(order_ids, MAX_CONNECTIONS):
-                with magento.Order(mgnapp.uri, mgnapp.username,
-                        mgnapp.password) as order_api:
-                    for order in order_api.info_multi(grouped_order_ids):
-                        self.create_mgn_order(order)
+            pending = 0
+            for chunk, fetch_failed in chunks:
+                start = time.time()
+                if fetch_failed:
+                    # keep the orders not possible to get for a later retry
+                    MagentoOrderFailed.register(self, 'fetch', fetch_failed)
+                    failed.extend(i for i, _ in fetch_failed)
+                    pending += 1
+                resolver.load_orders(chunk)
+                for order in chunk:
+                    last_id = order.get('increment_id')
+                    # each order in a savepoint: an error only rollback
+                    # the current order
+                    try:
+                        with savepoint('magento_order'):
+                            self.create_mgn_order(order, resolver)
+                    except Exception as e:
+                        increment_id = order.get('increment_id')
+                        failed.append(increment_id)
+                        logger.error(
+                            'Magento %s. Error import order %s: %s' % (
+                            self.name, increment_id, e))
+                        MagentoOrderFailed.register(self, 'create',
+                            [(increment_id, e)], {increment_id: order})
+                        pending += 1
+                        continue
+                    pending += 1
+                    if pending >= COMMIT_INTERVAL:
+                        if checkpoint:
+                            self.set_magento_checkpoint(last_id)
                         Transaction().commit()
+                        pending = 0
+                timing['write'] += time.time() - start
+            if pending:
+                if checkpoint and last_id:
+                    self.set_magento_checkpoint(last_id)
+                Transaction().commit()
+
+        # learned chunk size is the start of the next import
+        if order_ids:
+            mgnapp.set_orders_chunk_size(chunk_size.size)
 
+        if failed:
+            logger.warning('Magento %s. Not imported sales %s' % (
+                self.name, ', '.join(str(f) for f in failed)))
         logger.info(
-            'Magento %s. End import %s sales' % (self.name, len(order_ids)))
+            'Magento %s. End import %s sales. Fetch time %.2fs. '
+            'Write time %.2fs' % (self.name,
+                len(order_ids) + len(orders) - len(failed),
+                timing['fetch'], timing['write']))
 
-    def create_mgn_order(self, magento_data):
+    @classmethod
+    def fetch_mgn_orders(cls, credentials, order_ids, timing,
+            chunk_size=None):
+        '''
+        Get Magento orders info by chunks (generator)
+        Not use the transaction; it is run by a background thread
+        :param credentials: tuple from app_credentials
+        :param order_ids: list increment IDs
+        :param timing: dict to sum fetch time
+        :param chunk_size: AdaptiveChunkSize; fixed MAX_CONNECTIONS if None
+        yield tuples (orders, failed); failed is a list of
+            (increment_id, error) not possible to get
+        '''
+        if chunk_size is None:
+            chunk_size = AdaptiveChunkSize(MAX_CONNECTIONS,
+                maximum=MAX_CONNECTIONS, target_time=None)
+        order_ids = list(order_ids)
+        with magento_client(credentials, 'Order') as order_api:
+            index = 0
+            while index < len(order_ids):
+                grouped_order_ids = order_ids[index:index + chunk_size.size]
+                start = time.time()
+                try:
+                    orders, failed = cls.fetch_mgn_orders_isolated(order_api,
+                        grouped_order_ids,
+                        shrink=chunk_size.size > chunk_size.minimum)
+                except Exception as e:
+                    if not is_timeout(e):
+                        raise
+                    timing['fetch'] += time.time() - start
+                    chunk_size.failure()
+                    logger.warning('Magento. Timeout get %s orders. '
+                        'Retry with %s orders' % (
+                        len(grouped_order_ids), chunk_size.size))
+                    continue
+                elapsed = time.time() - start
+                timing['fetch'] += elapsed
+                chunk_size.success(elapsed,
+                    sum(len(o.get('items') or []) for o in orders))
+                index += len(grouped_order_ids)
+                yield orders, failed
+
+    @classmethod
+    def fetch_mgn_orders_isolated(cls, order_api, order_ids,
+            retries=FETCH_RETRIES, shrink=False):
+        '''
+        Get Magento orders info isolating the orders that fail
+        The call is retried with exponential backoff; when it still fails the
+        chunk is bisected until the bad increment IDs are found
+        :param order_api: logged Magento Order API client
+        :param order_ids: list increment IDs
+        :param retries: int retries before bisect the chunk
+        :param shrink: bool raise timeouts to get a smaller chunk size
+        return tuple (orders, failed); failed is a list of
+            (increment_id, error)
+        '''
+        backoff = FETCH_BACKOFF
+        for attempt in range(retries + 1):
+            try:
+                values = order_api.info_multi(order_ids)
+                break
+            except Exception as e:
+                if shrink and is_timeout(e):
+                    raise
+                error = e
+            if attempt < retries:
+                logger.warning('Magento. Error get %s orders: %s. '
+                    'Retry in %ss' % (len(order_ids), error, backoff))
+                time.sleep(backoff)
+                backoff *= 2
+        else:
+            if len(order_ids) == 1:
+                logger.error('Magento. Error get order %s: %s' % (
+                    order_ids[0], error))
+                return [], [(order_ids[0], error)]
+            # bisect: healthy halves are fetched at the first try
+            half = len(order_ids) // 2
+            orders, failed = [], []
+            for sub_ids in (order_ids[:half], order_ids[half:]):
+                sub_orders, sub_failed = cls.fetch_mgn_orders_isolated(
+                    order_api, sub_ids, retries=0)
+                orders.extend(sub_orders)
+                failed.extend(sub_failed)
+            return orders, failed
+
+        orders, failed = [], []
+        for increment_id, value in zip(order_ids, values):
+            if isinstance(value, dict) and value.get('isFault'):
+                logger.error('Magento. Error get order %s: %s' % (
+                    increment_id, value.get('faultMessage')))
+                failed.append((increment_id, value.get('faultMessage')))
+            else:
+                orders.append(value)
+        return orders, failed
+
+    def create_mgn_order(self, magento_data, resolver=None):
+        '''
+        Create a sale from a Magento order
+        :param magento_data: dict
+        :param resolver: MagentoOrderResolver of the import run; a new one
+            if None
+        '''
         Sale = Pool().get('sale.sale')
 
+        if resolver is None:
+            resolver = MagentoOrderResolver(self)
+
         # Convert Magento order to dict
-        party_values = self.mgn2party_values(magento_data)
-        invoice_values = self.mgn2invoice_values(magento_data)
-        shipment_values = self.mgn2shipment_values(magento_data)
+        party_values = self.mgn2party_values(magento_data, resolver)
+        invoice_values = self.mgn2invoice_values(magento_data, resolver)
+        shipment_values = self.mgn2shipment_values(magento_data, resolver)
         sale_values = self.mgn2order_values(magento_data)
         lines_values = self.mgn2lines_values(magento_data, party_values,
-            sale_values)
+            sale_values, resolver)
         extralines_values = self.mgn2extralines_values(magento_data)
 
         # Create order, lines, party and address
@@ -568,12 +1283,12 @@ class SaleShop(metaclass=PoolMeta):
                 self.name))
             return
 
-        with magento.Order(mgnapp.uri, mgnapp.username, mgnapp.password) \
-                as order_api:
+        with magento_client(mgnapp, 'Order') as order_api:
+            multicall = MagentoMultiCall(order_api)
             for sale in sales:
                 number_external = sale.number_external
                 status, notify, cancel = sale.convert_magento_status()
-                comment = None
+                comment = ''
 
                 if not status or status == sale.status:
                     logger.info(
@@ -581,13 +1296,21 @@ class SaleShop(metaclass=PoolMeta):
                         self.name, number_external))
                     continue
 
-                try:
-                    if cancel:
-                        order_api.cancel(number_external)
-                    else:
-                        order_api.addcomment(number_external, status,
-                            comment, notify)
+                if cancel:
+                    multicall.add((sale, status), 'sales_order.cancel',
+                        [number_external])
+                else:
+                    multicall.add((sale, status), 'sales_order.addComment',
+                        [number_external, status, comment, notify])
 
+            try:
+                for (sale, status), _, fault in multicall.execute():
+                    if fault:
+                        logger.error(
+                            'Magento %s. Not export state %s: %s' % (
+                            self.name, sale.number_external,
+                            fault.faultString))
+                        continue
                     Sale.write([sale], {
                         'status': status,
                         'status_history': '%s\n%s - %s' % (
@@ -595,14 +1318,13 @@ class SaleShop(metaclass=PoolMeta):
                             str(datetime.datetime.now()),
                             status),
                         })
-                    Transaction().commit()
                     logger.info(
                         'Magento %s. Export state %s - %s' % (
-                        self.name, number_external, status))
-                except:
-                    logger.error(
-                        'Magento %s. Not export state %s' % (
-                        self.name, sale.number_external))
+                        self.name, sale.number_external, status))
+            except Exception as e:
+                logger.error('Magento %s. Error export states: %s' % (
+                    self.name, e))
+            Transaction().commit()
 
         logger.info('Magento %s. End export state' % (self.name))
 
@@ -1,16 +1,25 @@
 # This file is part magento module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+import socket
 import unittest
 import trytond.tests.test_tryton
 from decimal import Decimal
-from mock import patch
+from xmlrpc.client import Fault, ProtocolError
+from mock import patch, Mock, MagicMock
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.modules.esale.tests.tools import sale_configuration
 from trytond.modules.company.tests import create_company, set_company
 from trytond.modules.account.tests import create_chart
+from trytond.modules.magento.tools import (AdaptiveChunkSize, address_key,
+    contact_key, diff_values)
+from trytond.modules.magento.magento_client import (is_timeout,
+    magento_client, MagentoClientPool, PooledAPI)
+from trytond.modules.magento import magento_client as client_module
+from trytond.modules.magento.shop import MagentoOrderResolver
 from . import tools
 
 
@@ -33,6 +42,9 @@ class MagentoTestCase(ModuleTestCase):
         Category = pool.get('product.category')
         Template = pool.get('product.template')
         Product = pool.get('product.product')
+        MagentoOrderLedger = pool.get('magento.order.ledger')
+        MagentoOrderFailed = pool.get('magento.order.failed')
+        MagentoOrderStaging = pool.get('magento.order.staging')
 
         company = create_company()
         with set_company(company):
@@ -114,6 +126,524 @@ class MagentoTestCase(ModuleTestCase):
 
             sale, = Sale.search([('number', '=', '100000001')])
             self.assertEqual(sale.number, '100000001')
+            self.assertEqual(
+                MagentoOrderLedger.get_imported(shop,
+                    ['100000001', '100000002']),
+                {'100000001'})
+
+            MagentoOrderFailed.register(shop, 'fetch',
+                [('100000002', 'Timeout')])
+            MagentoOrderFailed.register(shop, 'create',
+                [('100000002', 'Error')], {'100000002': {'increment_id':
+                    '100000002'}})
+            failed, = MagentoOrderFailed.search([])
+            self.assertEqual(failed.stage, 'create')
+            self.assertEqual(failed.state, 'pending')
+            self.assertTrue(failed.payload)
+
+            # retry the stored payload; commits are kept in the test
+            magento_data2 = tools.load_json('orders', '100000002')
+            MagentoOrderFailed.register(shop, 'create',
+                [('100000002', 'Error')], {'100000002': magento_data2})
+            with patch.object(Transaction, 'commit'):
+                MagentoOrderFailed.retry([failed])
+            self.assertEqual(MagentoOrderFailed.search([]), [])
+            self.assertEqual(
+                MagentoOrderLedger.get_imported(shop, ['100000002']),
+                {'100000002'})
+
+            staged, = MagentoOrderStaging.stage(shop, [magento_data])
+            self.assertEqual(MagentoOrderStaging.stage(shop, [magento_data]),
+                [])
+            self.assertEqual(
+                MagentoOrderStaging.load_payload(staged.payload),
+                magento_data)
+
+            # convert staged orders; commits are kept in the test
+            MagentoOrderStaging.stage(shop, [
+                    dict(magento_data2, increment_id='100000003'),
+                    {'increment_id': '100000005'},
+                    ])
+            staged = MagentoOrderStaging.search([('state', '=', 'staged')])
+            self.assertEqual(len(staged), 3)
+            with patch.object(Transaction, 'commit'):
+                MagentoOrderStaging.convert(staged)
+            self.assertEqual(
+                {s.increment_id: s.state
+                    for s in MagentoOrderStaging.search([])}, {
+                    '100000001': 'done',
+                    '100000003': 'done',
+                    '100000005': 'failed',
+                    })
+            sale, = Sale.search([('number_external', '=', '100000003')])
+            failed, = MagentoOrderFailed.search([])
+            self.assertEqual(failed.increment_id, '100000005')
+            self.assertEqual(failed.stage, 'create')
+            # a converted order is not claimed again
+            self.assertEqual(MagentoOrderStaging.claim(staged, ['staged']),
+                [])
+
+    @with_transaction()
+    def test_search_identifiers_by_suffix(self):
+        'Test search party identifiers that end with a code'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Identifier = pool.get('party.identifier')
+
+        party1, party2, party3 = Party.create([{
+                    'name': 'Party 1',
+                    'identifiers': [('create', [{'code': 'ES12345678Z'}])],
+                    }, {
+                    'name': 'Party 2',
+                    'identifiers': [('create', [{'code': 'ESB99999999'}])],
+                    }, {
+                    'name': 'Party 3',
+                    'identifiers': [('create', [{'code': '12345678Z'}])],
+                    }])
+        identifier1, = party1.identifiers
+        identifier2, = party2.identifiers
+        identifier3, = party3.identifiers
+        self.assertEqual(identifier1.code_reversed, 'Z87654321SE')
+
+        found = Identifier.search_by_suffix(
+            ['12345678z', 'b99999999', '00000000T', None])
+        self.assertEqual(found, {
+                # the same code before a code that ends with it
+                '12345678Z': identifier3,
+                'B99999999': identifier2,
+                })
+
+        Identifier.write([identifier1], {'code': 'es87654321x'})
+        self.assertEqual(identifier1.code_reversed, 'X12345678SE')
+        self.assertEqual(Identifier.search_by_suffix(['87654321X']),
+            {'87654321X': identifier1})
+
+    @with_transaction()
+    def test_external_referentials(self):
+        'Test create or update external referentials'
+        pool = Pool()
+        APP = pool.get('magento.app')
+        Referential = pool.get('magento.external.referential')
+
+        app = APP()
+        app.name = 'Test Magento'
+        app.uri = 'http://localhost'
+        app.username = 'test'
+        app.password = 'test'
+        app.save()
+        model = 'product.product'
+
+        def mapping():
+            return sorted((r.try_id, r.mgn_id)
+                for r in Referential.search([]))
+
+        # insert
+        ref1, ref2 = Referential.set_external_referentials(app, model,
+            [(1, 100), (2, 200)])
+        self.assertEqual(mapping(), [(1, 100), (2, 200)])
+        self.assertEqual(Referential.set_external_referential(app, model,
+                1, 100), ref1)
+
+        # update the mappings of a Magento ID and of a Tryton ID
+        self.assertEqual(Referential.set_external_referentials(app, model,
+                [(3, 100), (2, 201)]), [ref1, ref2])
+        self.assertEqual(mapping(), [(2, 201), (3, 100)])
+
+        # Magento ID and Tryton ID mapped to others: one mapping is kept
+        self.assertEqual(Referential.set_external_referentials(app, model,
+                [(2, 100)]), [ref1])
+        self.assertEqual(mapping(), [(2, 100)])
+
+        # duplicated keys in one batch: the last pair is saved once
+        refs = Referential.set_external_referentials(app, model,
+            [(5, 500), (5, 500), (6, 500), (6, 600)])
+        self.assertEqual(len(refs), 3)
+        self.assertEqual(len(set(refs)), 1)
+        self.assertEqual(mapping(), [(2, 100), (6, 600)])
+
+    @with_transaction()
+    def test_external_referentials_cache(self):
+        'Test the mapping cache of external referentials is cleared'
+        pool = Pool()
+        APP = pool.get('magento.app')
+        Referential = pool.get('magento.external.referential')
+
+        app = APP()
+        app.name = 'Test Magento'
+        app.uri = 'http://localhost'
+        app.username = 'test'
+        app.password = 'test'
+        app.save()
+        model = 'product.product'
+        model_id = Referential.get_model_id(model)
+
+        def try_id(mgn_id):
+            referential = Referential.get_mgn2try(app, model, mgn_id)
+            return referential.try_id if referential else None
+
+        self.assertEqual(try_id(100), None)
+        referential, = Referential.create([{
+                    'magento_app': app.id,
+                    'model': model_id,
+                    'try_id': 1,
+                    'mgn_id': 100,
+                    }])
+        self.assertEqual(try_id(100), 1)
+
+        Referential.write([referential], {'try_id': 2})
+        self.assertEqual(try_id(100), 2)
+        self.assertEqual(Referential.get_try2mgn(app, model, 1), None)
+
+        Referential.set_external_referentials(app, model, [(3, 100)])
+        self.assertEqual(try_id(100), 3)
+        self.assertEqual(Referential.get_try2mgn(app, model, 3).mgn_id, 100)
+
+        Referential.delete([referential])
+        self.assertEqual(try_id(100), None)
+
+    @with_transaction()
+    def test_resolver_missing_products(self):
+        'Test products not found in Magento are requested once by run'
+        pool = Pool()
+        APP = pool.get('magento.app')
+        MagentoWebsite = pool.get('magento.website')
+        Shop = pool.get('sale.shop')
+        Product = pool.get('product.product')
+
+        shop = Shop(name='Magento Test', magento_website=MagentoWebsite(
+                magento_app=APP(name='Test Magento', product_options=False)))
+        orders = [{'items': [{'sku': 'MISSING', 'product_type': 'simple'}]}]
+
+        resolver = MagentoOrderResolver(shop)
+        with patch.object(Product, 'create_products_magento',
+                return_value={}) as create_products:
+            resolver.load_orders(orders)
+            resolver.load_orders(orders)
+        create_products.assert_called_once_with(shop, ['MISSING'])
+        self.assertEqual(resolver.get_product('MISSING'), None)
+
+        # an error is not a missing product: the next chunk tries again
+        resolver = MagentoOrderResolver(shop)
+        with patch.object(Product, 'create_products_magento',
+                side_effect=socket.timeout()) as create_products:
+            resolver.load_orders(orders)
+            resolver.load_orders(orders)
+        self.assertEqual(create_products.call_count, 2)
+
+    def test_pooled_api_login(self):
+        'Test pooled clients login again when the session expires'
+        class API(object):
+            url = 'http://localhost'
+            client = object()
+            logins = 0
+
+            def __init__(self, faults):
+                self.faults = list(faults)
+
+            def __enter__(self):
+                self.logins += 1
+                return self
+
+            def call(self, resource_path, arguments):
+                if self.faults:
+                    raise self.faults.pop(0)
+                return resource_path
+
+            multiCall = call
+
+        class Client(PooledAPI, API):
+            pass
+
+        client = Client([Fault(5, 'Session expired. Try to relogin.')])
+        self.assertEqual(client.call('order.info', []), 'order.info')
+        self.assertEqual(client.logins, 1)
+        client = Client([Fault(5, 'Session expired. Try to relogin.')])
+        self.assertEqual(client.multiCall([]), [])
+        self.assertEqual(client.logins, 1)
+
+        client = Client([Fault(100, 'Requested order not exists.')])
+        with self.assertRaises(Fault):
+            client.call('order.info', [])
+        self.assertEqual(client.logins, 0)
+
+    def test_client_pool_size(self):
+        'Test the client pool keeps at most its size of idle clients'
+        pool = MagentoClientPool(2)
+        api_class = Mock(side_effect=lambda *args: MagicMock())
+        credentials = (1, 'http://localhost', 'test', 'test')
+
+        clients = [pool.get(credentials, api_class) for _ in range(3)]
+        self.assertEqual(len(set(map(id, clients))), 3)
+        for client in clients:
+            pool.put(credentials, api_class, client)
+        self.assertEqual(pool.idle[(credentials, api_class)], clients[:2])
+        clients[2].__exit__.assert_called_once_with(None, None, None)
+        self.assertFalse(clients[0].__exit__.called)
+
+        # idle clients are reused before new ones are created
+        self.assertIn(pool.get(credentials, api_class), clients[:2])
+        self.assertEqual(api_class.call_count, 3)
+
+        pool.clear(app_id=1)
+        self.assertEqual(pool.idle, {})
+        clients[0].__exit__.assert_called_once_with(None, None, None)
+
+    @with_transaction()
+    def test_clients_cleared_on_write(self):
+        'Test pooled clients of an APP are closed when its login changes'
+        pool = Pool()
+        APP = pool.get('magento.app')
+
+        app = APP()
+        app.name = 'Test Magento'
+        app.uri = 'http://localhost'
+        app.username = 'test'
+        app.password = 'test'
+        app.save()
+
+        api_class = tools.mock_customer_group_api()
+        key = ((app.id, 'http://localhost', 'test', 'test'), api_class)
+        with patch('magento.CustomerGroup', api_class, create=True), \
+                patch.object(client_module, '_pool',
+                    MagentoClientPool(2)) as client_pool:
+            with magento_client(app, 'CustomerGroup'):
+                pass
+            self.assertEqual(len(client_pool.idle[key]), 1)
+
+            APP.write([app], {'name': 'Magento'})
+            self.assertEqual(len(client_pool.idle[key]), 1)
+
+            APP.write([app], {'password': 'secret'})
+            self.assertEqual(client_pool.idle, {})
+
+    def test_adaptive_chunk_size(self):
+        'Test adaptive chunk size'
+        chunk_size = AdaptiveChunkSize(50, maximum=200, target_time=10,
+            target_payload=1000)
+        chunk_size.success(1, 100)
+        self.assertEqual(chunk_size.size, 62)
+        chunk_size.success(20, 100)
+        self.assertEqual(chunk_size.size, 31)
+        chunk_size.success(1, 2000)
+        self.assertEqual(chunk_size.size, 15)
+        chunk_size.failure()
+        self.assertEqual(chunk_size.size, 7)
+        for _ in range(50):
+            chunk_size.success(1, 10)
+        self.assertEqual(chunk_size.size, 200)
+        chunk_size = AdaptiveChunkSize(1)
+        chunk_size.failure()
+        self.assertEqual(chunk_size.size, 1)
+
+    def test_customer_keys(self):
+        'Test address and contact keys'
+        self.assertEqual(address_key('08 720', 'Carrer  Major\n1'),
+            address_key('08720', 'carrer major 1'))
+        self.assertNotEqual(address_key('08720', 'Carrer Major 1'),
+            address_key('08721', 'Carrer Major 1'))
+        self.assertEqual(contact_key('Info@Example.com '),
+            contact_key('info@example.com'))
+
+    def test_is_timeout(self):
+        'Test errors that reduce the chunk size'
+        self.assertTrue(is_timeout(socket.timeout()))
+        self.assertTrue(is_timeout(
+                ProtocolError('http://localhost', 504, 'Gateway Timeout', {})))
+        self.assertFalse(is_timeout(
+                ProtocolError('http://localhost', 404, 'Not Found', {})))
+        self.assertFalse(is_timeout(ValueError()))
+
+    def test_diff_values(self):
+        'Test values that change a record'
+        record = Mock(code='es', name='Spanish', magento_storegroup=Mock(id=1))
+        self.assertEqual(diff_values(record, {
+                    'code': 'es',
+                    'name': 'Español',
+                    'magento_storegroup': 1,
+                    }), {'name': 'Español'})
+        self.assertEqual(diff_values(record, {'magento_storegroup': 2}),
+            {'magento_storegroup': 2})
+
+    @with_transaction()
+    def test_fetch_orders_isolated(self):
+        'Test bisect orders chunk to isolate bad orders'
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+
+        def info_multi(order_ids):
+            if '3' in order_ids:
+                raise Exception('Bad order')
+            return [{'increment_id': i} for i in order_ids]
+
+        with patch('trytond.modules.magento.shop.FETCH_BACKOFF', 0):
+            order_api = Mock()
+            order_api.info_multi.side_effect = info_multi
+            orders, failed = Shop.fetch_mgn_orders_isolated(order_api,
+                ['1', '2', '3', '4', '5'], retries=1)
+        self.assertEqual([o['increment_id'] for o in orders],
+            ['1', '2', '4', '5'])
+        self.assertEqual([i for i, _ in failed], ['3'])
+
+    @with_transaction()
+    def test_backfill_windows(self):
+        'Test split backfill date range in windows'
+        pool = Pool()
+        Backfill = pool.get('magento.order.backfill')
+
+        backfill = Backfill(date_from=datetime.datetime(2020, 1, 1),
+            date_to=datetime.datetime(2020, 1, 3, 12), window_hours=24)
+        windows = backfill.get_windows()
+        self.assertEqual(len(windows), 3)
+        self.assertEqual(windows[0], (datetime.datetime(2020, 1, 1),
+                datetime.datetime(2020, 1, 1, 23, 59, 59)))
+        self.assertEqual(windows[-1][1], datetime.datetime(2020, 1, 3, 12))
+
+    @with_transaction()
+    def test_list_orders_by_pages(self):
+        'Test list orders by pages with gaps of entity IDs'
+        pool = Pool()
+        APP = pool.get('magento.app')
+        MagentoWebsite = pool.get('magento.website')
+        Shop = pool.get('sale.shop')
+
+        # entity IDs with a gap of 1000 deleted orders
+        orders = [{
+                'order_id': i if i < 30 else i + 1000,
+                'increment_id': str(100000000 + i),
+                'created_at': '2020-01-01 00:%02d:00' % i,
+                } for i in range(1, 60)]
+
+        def list_orders(filters):
+            created_at = filters['created_at']
+            return [o for o in orders
+                if created_at['from'] <= o['created_at'] <= created_at['to']]
+
+        shop = Shop(magento_website=MagentoWebsite(
+                magento_app=APP(name='Test Magento')))
+        order_api = Mock()
+        order_api.list.side_effect = list_orders
+        pages = list(shop.list_mgn_order_ids(order_api, {
+                    'created_at': {
+                        'from': '2020-01-01 00:20:00',
+                        'to': '2020-01-01 00:59:59',
+                        },
+                    }, 10))
+        self.assertTrue(all(len(p) <= 10 for p in pages))
+        self.assertEqual(sum(pages, []),
+            [str(100000000 + i) for i in range(20, 60)])
+
+
+    @with_transaction()
+    def test_sync_customers_by_windows(self):
+        'Test sync customers by windows of updated dates'
+        pool = Pool()
+        APP = pool.get('magento.app')
+
+        app = APP()
+        app.name = 'Test Magento'
+        app.uri = 'http://localhost'
+        app.username = 'test'
+        app.password = 'test'
+        app.customers_updated_at = datetime.datetime(2020, 1, 1)
+        app.save()
+
+        customers = [{
+                'customer_id': i,
+                'updated_at': '2020-01-%02d 12:00:00' % i,
+                } for i in range(1, 29)]
+
+        def list_customers(filters):
+            updated_at = filters['updated_at']
+            return [c for c in customers
+                if updated_at['from'] <= c['updated_at'] <= updated_at['to']]
+
+        customer_api = Mock()
+        customer_api.list.side_effect = list_customers
+        client = MagicMock()
+        client.__enter__.return_value = customer_api
+        saved = []
+        with patch('trytond.modules.magento.magento_core.magento_client',
+                    return_value=client), \
+                patch('trytond.modules.magento.magento_core.'
+                    'CUSTOMERS_PAGE_SIZE', 5), \
+                patch('trytond.modules.magento.magento_core.'
+                    'CUSTOMERS_SYNC_DAYS', 10), \
+                patch.object(APP, 'save_customers', autospec=True,
+                    side_effect=lambda app, c: saved.extend(c)), \
+                patch.object(Transaction, 'commit'):
+            app.sync_customers()
+
+        self.assertEqual([c['customer_id'] for c in saved],
+            list(range(1, 29)))
+        for call in customer_api.list.call_args_list:
+            updated_at = call[0][0]['updated_at']
+            self.assertGreaterEqual(updated_at['from'], '2020-01-01 00:00:01')
+            self.assertLessEqual(len(list_customers(call[0][0])), 5)
+        self.assertGreater(app.customers_updated_at,
+            datetime.datetime(2020, 1, 28, 12))
+        self.assertEqual(app.customers_sync_until, None)
+
+
+    @with_transaction()
+    def test_customer_shards(self):
+        'Test claim, stale recovery and APP update of customer shards'
+        pool = Pool()
+        APP = pool.get('magento.app')
+        Shard = pool.get('magento.app.customer.shard')
+
+        app = APP()
+        app.name = 'Test Magento'
+        app.uri = 'http://localhost'
+        app.username = 'test'
+        app.password = 'test'
+        app.from_id_customers = 1
+        app.to_id_customers = 30
+        app.save()
+
+        with patch('trytond.modules.magento.magento_core.'
+                'CUSTOMERS_SHARD_SIZE', 10):
+            shards = Shard.create_shards(app, 1, 30)
+        self.assertEqual([(s.from_id, s.to_id) for s in shards],
+            [(1, 10), (11, 20), (21, 30)])
+        shard1, shard2, shard3 = [s.id for s in shards]
+
+        # claim up to the concurrency of the APP
+        with patch.object(Shard, '_job_concurrency', 2):
+            self.assertTrue(Shard.claim(Shard(shard1)))
+            self.assertFalse(Shard.claim(Shard(shard1)))
+            self.assertTrue(Shard.claim(Shard(shard2)))
+            self.assertFalse(Shard.claim(Shard(shard3)))
+
+            # a stale shard is not counted
+            Shard.write([Shard(shard1)], {
+                    'heartbeat': datetime.datetime.now()
+                    - datetime.timedelta(seconds=Shard._job_timeout + 1),
+                    })
+            self.assertTrue(Shard(shard1).is_stale())
+            self.assertFalse(Shard(shard2).is_stale())
+            self.assertTrue(Shard.claim(Shard(shard3)))
+
+        # only the stale running shard is dispatched again
+        with patch.object(Shard, 'enqueue') as enqueue:
+            self.assertEqual(Shard.requeue(Shard.browse(
+                        [shard1, shard2, shard3])), [Shard(shard1)])
+        enqueue.assert_called_once_with([Shard(shard1)])
+        self.assertEqual(Shard(shard1).state, 'pending')
+
+        # the APP moves forward only when all its shards are done
+        Shard.write([Shard(shard2), Shard(shard3)], {'state': 'done'})
+        Shard.update_apps([APP(app.id)])
+        self.assertEqual(APP(app.id).from_id_customers, 1)
+
+        with patch.object(APP, 'import_customers') as import_customers, \
+                patch.object(Transaction, 'commit'):
+            Shard.run([Shard(shard1)])
+        import_customers.assert_called_once()
+        self.assertEqual(import_customers.call_args[0][:2], (1, 10))
+        self.assertEqual(Shard(shard1).state, 'done')
+        app = APP(app.id)
+        self.assertEqual(app.from_id_customers, 31)
+        self.assertEqual(app.to_id_customers, None)
 
 
 def suite():
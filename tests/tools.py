@@ -48,6 +48,8 @@ def mock_region_api():
     handle = MagicMock(spec=magento.Region)
     # handle.list.side_effect = load_json('grups', 'customer_groups')
     handle.list.return_value = load_json('regions', 'regions')
+    handle.multiCall.side_effect = lambda calls: [
+        load_json('regions', 'regions') for _ in calls]
     handle.__enter__.return_value = handle
     mock.return_value = handle
     return mock
@@ -2,10 +2,23 @@
 # This file is part magento module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+import logging
+import socket
 import unicodedata
+import threading
+from contextlib import contextmanager
 from decimal import Decimal
+from queue import Queue, Empty, Full
+from xmlrpc.client import Fault, ProtocolError
+from sql import For
+from trytond.pool import Pool
+from trytond.transaction import Transaction
 
 SRC_CHARS = u"""/*+?¿!&$[]{}`^<>=~%|\\"""
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+logger = logging.getLogger(__name__)
+
 
 def unaccent(text):
     if not text:
@@ -36,6 +49,36 @@ def remove_newlines(text):
     return ' '.join(text.splitlines())
 
 
+def address_key(zip, street):
+    '''
+    Return a key to compare addresses: zip and street normalized
+    '''
+    return ((zip or '').replace(' ', '').upper(),
+        ' '.join(unaccent(remove_newlines(street or '')).split()))
+
+
+def contact_key(value):
+    '''
+    Return a key to compare contact mechanisms: value normalized
+    '''
+    return ''.join((value or '').split()).lower()
+
+
+def diff_values(record, values):
+    '''
+    Return the values that change a record
+    Many2One values are compared by ID
+    '''
+    changed = {}
+    for name, value in values.items():
+        current = getattr(record, name, None)
+        if hasattr(current, 'id'):
+            current = current.id
+        if current != value:
+            changed[name] = value
+    return changed
+
+
 def base_price_without_tax(price, rate, currency=None):
     '''
     From price with taxes and return price without tax
@@ -58,3 +101,322 @@ def base_price_with_tax(price, rate, currency=None):
     price = price * (1 + rate)
     precision = currency.digits if currency else 2
     return Decimal('{:.{prec}f}'.format(price, prec=precision))
+
+
+def prefetch(iterable, depth):
+    '''
+    Iterate over iterable in a background thread, keeping up to depth
+    items ready in a bounded queue while the caller consumes them.
+    The iterable must not use the Tryton transaction.
+    Exceptions of the iterable are raised in the caller.
+    :param iterable: iterable
+    :param depth: int maximum items prefetched. 0 to not use a thread
+    '''
+    if depth < 1:
+        for item in iterable:
+            yield item
+        return
+
+    queue = Queue(depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                item, error = queue.get(timeout=1)
+            except Empty:
+                if thread.is_alive():
+                    continue
+                # the last items could be put before the producer ended
+                try:
+                    item, error = queue.get_nowait()
+                except Empty:
+                    return
+            if item is end:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def list_windows(list_method, ofilter, field, start, end, max_rows,
+        min_seconds=60, max_seconds=None, to_str=None):
+    '''
+    List Magento records by windows of a date field (generator)
+    A window is split in two halves when the listing fails or returns more
+    than max_rows records, so each listing keeps a bounded number of
+    records. Windows longer than max_seconds are split before they are
+    listed. Windows are yielded from the oldest.
+    :param list_method: function(filters) of a Magento API (order_api.list)
+    :param ofilter: dict other filters
+    :param field: str date field (created_at, updated_at)
+    :param start: datetime
+    :param end: datetime
+    :param max_rows: int
+    :param min_seconds: int windows of this length are not split
+    :param max_seconds: int longest window listed (None: no limit)
+    :param to_str: function(datetime) to format dates for Magento
+    yield tuples (window end datetime, list of records)
+    '''
+    if to_str is None:
+        to_str = lambda d: d.strftime(DATETIME_FORMAT)
+
+    windows = [(start, end)]
+    while windows:
+        start, end = windows.pop()
+        wfilter = dict(ofilter)
+        wfilter[field] = {
+            'from': to_str(start),
+            'to': to_str(end),
+            }
+        seconds = (end - start).total_seconds()
+        splittable = seconds > min_seconds
+        records = None
+        if not max_seconds or seconds <= max_seconds:
+            try:
+                records = list_method(wfilter)
+            except (socket.timeout, ProtocolError, Fault) as e:
+                # a too large listing could also end in a server error
+                if not splittable:
+                    raise
+                logger.warning('Magento. Error list %s: %s' % (wfilter, e))
+        if splittable and (records is None or len(records) > max_rows):
+            middle = (start + (end - start) / 2).replace(microsecond=0)
+            logger.info('Magento. Split window %s.' % (wfilter[field]))
+            windows.append((middle + datetime.timedelta(seconds=1), end))
+            windows.append((start, middle))
+            continue
+        yield end, records
+
+
+@contextmanager
+def savepoint(name='magento'):
+    '''
+    Run the block inside a database savepoint. On error, only the changes of
+    the block are rolled back and the error is raised again.
+    :param name: str savepoint name
+    '''
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        for cache in transaction.cache.values():
+            cache.clear()
+        raise
+    else:
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
+class AdaptiveChunkSize(object):
+    '''
+    Chunk size that grows while requests stay under the time and payload
+    targets and shrinks when they go over or time out.
+    '''
+
+    def __init__(self, size, minimum=1, maximum=None, target_time=None,
+            target_payload=None, growth=1.25):
+        '''
+        :param size: int initial size
+        :param minimum: int minimum size
+        :param maximum: int maximum size
+        :param target_time: float seconds for each request
+        :param target_payload: int payload units (lines,...) for each request
+        :param growth: float factor to grow the size
+        '''
+        self.minimum = max(minimum, 1)
+        self.maximum = maximum
+        self.target_time = target_time
+        self.target_payload = target_payload
+        self.growth = growth
+        self.size = self._bound(size or self.minimum)
+
+    def _bound(self, size):
+        size = max(self.minimum, int(size))
+        if self.maximum:
+            size = min(self.maximum, size)
+        return size
+
+    def success(self, elapsed, payload=None):
+        '''
+        Learn from a request done
+        :param elapsed: float seconds of the request
+        :param payload: int payload units of the request
+        '''
+        ratios = []
+        if self.target_time and elapsed:
+            ratios.append(self.target_time / elapsed)
+        if self.target_payload and payload:
+            ratios.append(self.target_payload / payload)
+        ratio = min(ratios) if ratios else self.growth
+        if ratio >= 1:
+            size = max(self.size + 1, self.size * min(ratio, self.growth))
+        else:
+            size = self.size * ratio
+        self.size = self._bound(size)
+
+    def failure(self):
+        '''
+        Learn from a request that timed out: half the size
+        '''
+        self.size = self._bound(self.size // 2)
+
+
+class MagentoJobMixin(object):
+    '''
+    Records run as queue jobs (pending, running, done, failed) with a
+    concurrency limit by Magento APP. A running record without heartbeat
+    in _job_timeout seconds is stale: its worker is lost.
+    Models define _job_app (field path to the magento.app), _job_timeout,
+    _job_concurrency, _job_delay and the methods get_job_app, run_job and
+    jobs_finished.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def enqueue(cls, jobs, delay=None):
+        '''
+        Dispatch records to the queue; each record is a job
+        :param jobs: list of records
+        :param delay: int seconds to wait before run the jobs
+        '''
+        context = {'queue_name': 'magento'}
+        if delay:
+            context['queue_scheduled_at'] = datetime.timedelta(seconds=delay)
+        with Transaction().set_context(**context):
+            for job in jobs:
+                cls.__queue__.run([job])
+
+    @classmethod
+    def requeue(cls, jobs):
+        '''
+        Dispatch again the failed records and the stale running records
+        :param jobs: list of records
+        return list of records dispatched
+        '''
+        jobs = [j for j in jobs
+            if j.state == 'failed' or (j.state == 'running' and j.is_stale())]
+        if jobs:
+            cls.write(jobs, {'state': 'pending', 'error': None})
+            cls.enqueue(jobs)
+        return jobs
+
+    def is_stale(self):
+        '''
+        Running record without progress in _job_timeout
+        return bool
+        '''
+        return (not self.heartbeat or self.heartbeat < datetime.datetime.now()
+            - datetime.timedelta(seconds=self._job_timeout))
+
+    @classmethod
+    def claim(cls, job):
+        '''
+        Set the record as running when its Magento APP has less running
+        records than _job_concurrency; stale records are not counted
+        :param job: record
+        return bool
+        '''
+        App = Pool().get('magento.app')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        app_table = App.__table__()
+        now = datetime.datetime.now()
+
+        app = job.get_job_app()
+        # claims of the same APP wait each other on the APP row
+        if transaction.database.has_select_for():
+            cursor.execute(*app_table.select(app_table.id,
+                    where=app_table.id == app.id,
+                    for_=For('UPDATE')))
+        running = cls.search([
+                (cls._job_app, '=', app.id),
+                ('state', '=', 'running'),
+                ('heartbeat', '>=',
+                    now - datetime.timedelta(seconds=cls._job_timeout)),
+                ], count=True)
+        if running >= cls._job_concurrency:
+            return False
+        cursor.execute(*table.update([table.state, table.heartbeat],
+                ['running', now],
+                where=(table.id == job.id) & (table.state == 'pending')))
+        return bool(cursor.rowcount)
+
+    @classmethod
+    def run(cls, jobs):
+        '''
+        Run the pending records claimed; the others of an APP at its limit
+        are dispatched again later
+        :param jobs: list of records
+        '''
+        for job in jobs:
+            if job.state != 'pending':
+                continue
+            if not cls.claim(job):
+                # concurrency limit of the Magento APP: run it later
+                cls.enqueue([job], delay=cls._job_delay)
+                continue
+            Transaction().commit()
+
+            try:
+                job.run_job()
+            except Exception as e:
+                Transaction().rollback()
+                logger.error('Magento %s. Error %s: %s' % (
+                    job.get_job_app().name, job.rec_name, e))
+                cls.write([job], {'state': 'failed', 'error': str(e)})
+            else:
+                cls.write([job], {'state': 'done'})
+            Transaction().commit()
+
+        # a retried job could find its record done: always check them
+        cls.jobs_finished(jobs)
+        Transaction().commit()
+
+    def get_job_app(self):
+        '''
+        Magento APP of the record
+        return magento.app
+        '''
+        raise NotImplementedError
+
+    def run_job(self):
+        '''
+        Run the work of the record; progress is saved with a heartbeat
+        '''
+        raise NotImplementedError
+
+    @classmethod
+    def jobs_finished(cls, jobs):
+        '''
+        Update the records that depend on the jobs run
+        :param jobs: list of records
+        '''
+        pass